@@ -0,0 +1,444 @@
+import itertools, json, re, struct
+import yaml
+import astnodes
+
+# Marks a map entry of unpack() or read_yaml() still waiting for its
+# key, and a document read_yaml() has not read yet
+END = object()
+
+# The file formats of -emit-ast and -from-ast, all holding the dict
+# shape of astnodes' to_dict():
+#
+#   yaml  the original format, written with libyaml when PyYAML has it
+#   json  one JSON document
+#   bin   MessagePack, readable by any MessagePack library; only nil,
+#         booleans, ints, float64, str, arrays and maps are used
+
+FORMATS = ("yaml", "json", "bin")
+
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_MAP = "tag:yaml.org,2002:map"
+YAML_SEQ = "tag:yaml.org,2002:seq"
+# The types of the scalars in an AST
+YAML_SCALARS = (str, int, float, bool, type(None))
+
+def pack(value, out):
+    """
+    Append the MessagePack encoding of value to the bytearray out.
+    Arrays and maps are entered through an explicit stack of their
+    items, so deep ASTs do not exhaust the Python stack.
+    """
+    stack = [iter((value,))]
+    while stack:
+        for value in stack[-1]:
+            kind = type(value)
+            # the strings and maps of the AST come first
+            if kind is str:
+                data = value.encode("utf8")
+                size = len(data)
+                if size < 0x20:
+                    out.append(0xa0 | size)
+                elif size < 0x100:
+                    out += b"\xd9" + struct.pack(">B", size)
+                elif size < 0x10000:
+                    out += b"\xda" + struct.pack(">H", size)
+                else:
+                    out += b"\xdb" + struct.pack(">I", size)
+                out += data
+            elif kind is dict:
+                size = len(value)
+                if size < 0x10:
+                    out.append(0x80 | size)
+                elif size < 0x10000:
+                    out += b"\xde" + struct.pack(">H", size)
+                else:
+                    out += b"\xdf" + struct.pack(">I", size)
+                stack.append(itertools.chain.from_iterable(value.items()))
+                break
+            elif kind is list:
+                size = len(value)
+                if size < 0x10:
+                    out.append(0x90 | size)
+                elif size < 0x10000:
+                    out += b"\xdc" + struct.pack(">H", size)
+                else:
+                    out += b"\xdd" + struct.pack(">I", size)
+                stack.append(iter(value))
+                break
+            elif value is None:
+                out.append(0xc0)
+            elif value is True:
+                out.append(0xc3)
+            elif value is False:
+                out.append(0xc2)
+            elif kind is int:
+                if 0 <= value < 0x80:
+                    out.append(value)
+                elif -0x20 <= value < 0:
+                    out.append(value & 0xff)
+                elif -(1 << 31) <= value < (1 << 31):
+                    out += b"\xd2" + struct.pack(">i", value)
+                elif -(1 << 63) <= value < (1 << 63):
+                    out += b"\xd3" + struct.pack(">q", value)
+                else:
+                    out += b"\xcf" + struct.pack(">Q", value)
+            elif kind is float:
+                out += b"\xcb" + struct.pack(">d", value)
+            else:
+                raise TypeError("cannot pack %r" % (value,))
+        else:
+            stack.pop()
+
+# key: first byte, value: (struct format of the size, kind)
+SIZED = {
+    0xd9: (">B", "str"), 0xda: (">H", "str"), 0xdb: (">I", "str"),
+    0xdc: (">H", "array"), 0xdd: (">I", "array"),
+    0xde: (">H", "map"), 0xdf: (">I", "map"),
+}
+# key: first byte, value: struct format of the number that follows
+NUMBERS = {
+    0xca: ">f", 0xcb: ">d",
+    0xcc: ">B", 0xcd: ">H", 0xce: ">I", 0xcf: ">Q",
+    0xd0: ">b", 0xd1: ">h", 0xd2: ">i", 0xd3: ">q",
+}
+
+def unpack(data, pos=0):
+    """
+    The value MessagePack-encoded in the bytes data at pos, and the
+    position after it.  Raises ValueError on data that pack() does
+    not write.
+    """
+    # the arrays and maps being filled, as [container, entries left,
+    # key]; a map entry reads its key into key first, then its value
+    stack = []
+    while True:
+        first = data[pos]
+        pos += 1
+        # the short strings and maps of the AST come first
+        if 0xa0 <= first < 0xc0:
+            size, kind = first & 0x1f, "str"
+        elif 0x80 <= first < 0x90:
+            size, kind = first & 0x0f, "map"
+        elif first < 0x80:
+            size, kind = first, "value"
+        elif 0x90 <= first < 0xa0:
+            size, kind = first & 0x0f, "array"
+        elif first >= 0xe0:
+            size, kind = first - 0x100, "value"
+        elif first == 0xc0:
+            size, kind = None, "value"
+        elif first in (0xc2, 0xc3):
+            size, kind = first == 0xc3, "value"
+        elif first in NUMBERS:
+            fmt = NUMBERS[first]
+            size, kind = struct.unpack_from(fmt, data, pos)[0], "value"
+            pos += struct.calcsize(fmt)
+        elif first in SIZED:
+            fmt, kind = SIZED[first]
+            size = struct.unpack_from(fmt, data, pos)[0]
+            pos += struct.calcsize(fmt)
+        else:
+            raise ValueError("unsupported MessagePack type 0x%02x" % first)
+        if kind == "value":
+            value = size
+        elif kind == "str":
+            if pos + size > len(data):
+                raise ValueError("truncated MessagePack string")
+            value = data[pos:pos + size].decode("utf8")
+            pos += size
+        else:
+            value = {} if kind == "map" else []
+            if size:
+                stack.append([value, size, END])
+                continue
+        # store the value, and every container it completes, in the
+        # container around it
+        while stack:
+            entry = stack[-1]
+            container = entry[0]
+            if isinstance(container, dict):
+                if entry[2] is END:
+                    entry[2] = value
+                    break
+                container[entry[2]] = value
+                entry[2] = END
+            else:
+                container.append(value)
+            entry[1] -= 1
+            if entry[1]:
+                break
+            stack.pop()
+            value = container
+        else:
+            return value, pos
+
+def write_json(value, output):
+    # json.dump(value, output, separators=(",", ":")) with an explicit
+    # stack instead of recursion, for trees too deep for the json
+    # module; every stack entry yields the prefix and the value of the
+    # next item of an array or object
+    parts = []
+    stack = [iter((("", value),))]
+    closers = [""]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+            parts.append(closers.pop())
+            continue
+        prefix, value = item
+        parts.append(prefix)
+        if isinstance(value, dict):
+            parts.append("{")
+            stack.append((("," if i else "") + json.dumps(key) + ":", item)
+                         for i, (key, item) in enumerate(value.items()))
+            closers.append("}")
+        elif isinstance(value, list):
+            parts.append("[")
+            stack.append((("," if i else ""), item) for i, item in enumerate(value))
+            closers.append("]")
+        else:
+            parts.append(json.dumps(value))
+    output.write("".join(parts))
+
+JSON_SPACE = re.compile(r"[ \t\n\r]*")
+JSON_WORD = re.compile(r"[a-z]+")
+JSON_CONSTANTS = {"true": True, "false": False, "null": None}
+
+def json_key(text, pos):
+    # the key of an object member at pos and the position of its value
+    if text[pos:pos + 1] != '"':
+        raise ValueError("expecting a property name at char %d" % pos)
+    key, pos = json.decoder.scanstring(text, pos + 1)
+    pos = JSON_SPACE.match(text, pos).end()
+    if text[pos:pos + 1] != ":":
+        raise ValueError("expecting ':' at char %d" % pos)
+    return key, JSON_SPACE.match(text, pos + 1).end()
+
+def read_json(text):
+    """
+    The value of the JSON document text, read like json.loads but with
+    an explicit stack of the open arrays and objects instead of
+    recursion, for trees too deep for the json module.  Raises
+    ValueError on malformed JSON.
+    """
+    # the open arrays and objects, as [container, key]
+    stack = []
+    pos = JSON_SPACE.match(text).end()
+    while True:
+        char = text[pos:pos + 1]
+        if char == "{" or char == "[":
+            value = {} if char == "{" else []
+            pos = JSON_SPACE.match(text, pos + 1).end()
+            if text[pos:pos + 1] == ("}" if char == "{" else "]"):
+                pos += 1
+            else:
+                key = None
+                if char == "{":
+                    key, pos = json_key(text, pos)
+                stack.append([value, key])
+                continue
+        elif char == '"':
+            value, pos = json.decoder.scanstring(text, pos + 1)
+        else:
+            number = json.scanner.NUMBER_RE.match(text, pos)
+            if number:
+                integer, fraction, exponent = number.groups()
+                if fraction or exponent:
+                    value = float(number.group())
+                else:
+                    value = int(integer)
+                pos = number.end()
+            else:
+                word = JSON_WORD.match(text, pos)
+                if not word or word.group() not in JSON_CONSTANTS:
+                    raise ValueError("expecting a value at char %d" % pos)
+                value = JSON_CONSTANTS[word.group()]
+                pos = word.end()
+        # store the value, and every container it completes, in the
+        # container around it
+        while stack:
+            container, key = stack[-1]
+            if key is None:
+                container.append(value)
+            else:
+                container[key] = value
+            pos = JSON_SPACE.match(text, pos).end()
+            char = text[pos:pos + 1]
+            if char == ",":
+                pos = JSON_SPACE.match(text, pos + 1).end()
+                if key is not None:
+                    stack[-1][1], pos = json_key(text, pos)
+                break
+            if char != ("}" if key is not None else "]"):
+                raise ValueError("expecting ',' at char %d" % pos)
+            pos += 1
+            stack.pop()
+            value = container
+        else:
+            pos = JSON_SPACE.match(text, pos).end()
+            if pos != len(text):
+                raise ValueError("extra data at char %d" % pos)
+            return value
+
+def write_yaml(value, output):
+    # yaml.dump(value, output) with the events of the tree emitted from
+    # an explicit stack: both PyYAML's representer and libyaml's
+    # serializer recurse, the latter in C, so deep trees would overflow
+    # the stack and crash the process
+    dumper = YamlDumper(output, default_flow_style=False)
+    try:
+        dumper.open()
+        dumper.emit(yaml.DocumentStartEvent(explicit=False))
+        stack = [iter((value,))]
+        ends = [None]
+        while stack:
+            for value in stack[-1]:
+                if isinstance(value, dict):
+                    dumper.emit(yaml.MappingStartEvent(None, YAML_MAP, True, flow_style=False))
+                    # sorted like yaml.dump sorts the keys
+                    items = sorted(value.items(), key=lambda item: item[0])
+                    stack.append(itertools.chain.from_iterable(items))
+                    ends.append(yaml.MappingEndEvent())
+                    break
+                if isinstance(value, list):
+                    dumper.emit(yaml.SequenceStartEvent(None, YAML_SEQ, True, flow_style=False))
+                    stack.append(iter(value))
+                    ends.append(yaml.SequenceEndEvent())
+                    break
+                node = dumper.represent_data(value)
+                implicit = (node.tag == dumper.resolve(yaml.ScalarNode, node.value, (True, False)),
+                            node.tag == dumper.resolve(yaml.ScalarNode, node.value, (False, True)))
+                dumper.emit(yaml.ScalarEvent(None, node.tag, implicit, node.value, style=node.style))
+            else:
+                stack.pop()
+                end = ends.pop()
+                if end is not None:
+                    dumper.emit(end)
+        dumper.emit(yaml.DocumentEndEvent(explicit=False))
+        dumper.close()
+    finally:
+        dumper.dispose()
+
+def read_yaml(data):
+    """
+    The value of the YAML document data, read like yaml.safe_load but
+    built from the parser's events with an explicit stack of the open
+    mappings and sequences, as libyaml's composer recurses in C.  Only
+    the plain scalars, mappings and sequences that dump() writes are
+    read; raises ValueError or yaml.YAMLError on anything else.
+    """
+    loader = YamlLoader(data)
+    try:
+        # the open mappings and sequences, as [container, key]; a
+        # mapping entry reads its key into key first, then its value
+        stack = []
+        anchors = {}
+        document = END
+        while True:
+            event = loader.get_event()
+            if isinstance(event, yaml.StreamEndEvent):
+                return None if document is END else document
+            if isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent, yaml.DocumentEndEvent)):
+                continue
+            if isinstance(event, yaml.AliasEvent):
+                value = anchors[event.anchor]
+            elif isinstance(event, yaml.ScalarEvent):
+                tag = event.tag
+                if tag is None or tag == "!":
+                    tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+                node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style)
+                value = loader.construct_object(node)
+                loader.constructed_objects.clear()
+                if not isinstance(value, YAML_SCALARS):
+                    raise ValueError("unsupported YAML value of type %s" % tag)
+                if event.anchor is not None:
+                    anchors[event.anchor] = value
+            elif isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                if event.tag not in (None, "!", YAML_MAP, YAML_SEQ):
+                    raise ValueError("unsupported YAML tag %s" % event.tag)
+                value = {} if isinstance(event, yaml.MappingStartEvent) else []
+                if event.anchor is not None:
+                    anchors[event.anchor] = value
+                stack.append([value, END])
+                continue
+            else:
+                # the end of a mapping or sequence
+                value = stack.pop()[0]
+            if not stack:
+                if document is not END:
+                    raise ValueError("more than one YAML document")
+                document = value
+                continue
+            entry = stack[-1]
+            if isinstance(entry[0], list):
+                entry[0].append(value)
+            elif entry[1] is END:
+                entry[1] = value
+            else:
+                entry[0][entry[1]] = value
+                entry[1] = END
+    finally:
+        loader.dispose()
+
+def dump(ast, fmt, output):
+    """
+    Write the AST in the format fmt to output, a text file, or a
+    binary file for 'bin'.
+    """
+    d = ast.to_dict()
+    if fmt == "yaml":
+        write_yaml(d, output)
+    elif fmt == "json":
+        try:
+            text = json.dumps(d, separators=(",", ":"))
+        except RecursionError:
+            write_json(d, output)
+        else:
+            output.write(text)
+        output.write("\n")
+    else:
+        out = bytearray()
+        pack(d, out)
+        output.write(out)
+
+def detect(data):
+    # MessagePack maps start with 0x80-0x8f, 0xde or 0xdf and JSON
+    # documents with '{'; anything else is taken for YAML
+    text = data.lstrip()
+    if not text:
+        return "yaml"
+    if 0x80 <= text[0] <= 0x8f or text[0] in (0xde, 0xdf):
+        return "bin"
+    if text[:1] == b"{":
+        return "json"
+    return "yaml"
+
+def load(path):
+    """
+    The AST (an astnodes.Prog) stored at path in any of FORMATS.
+    Raises ValueError when the file does not hold a program's AST.
+    """
+    with open(path, "rb") as input:
+        data = input.read()
+    fmt = detect(data)
+    try:
+        if fmt == "bin":
+            d, end = unpack(data)
+            if end != len(data):
+                raise ValueError("trailing data after the AST")
+        elif fmt == "json":
+            try:
+                d = json.loads(data)
+            except RecursionError:
+                d = read_json(data.decode("utf8"))
+        else:
+            d = read_yaml(data)
+        ast = astnodes.from_dict(d)
+    except (KeyError, IndexError, TypeError, AttributeError, struct.error,
+            UnicodeDecodeError, yaml.YAMLError, RecursionError) as e:
+        raise ValueError("%s: %s" % (type(e).__name__, e))
+    if not isinstance(ast, astnodes.Prog):
+        raise ValueError("the AST is not a whole program")
+    return ast
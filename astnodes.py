@@ -0,0 +1,403 @@
+import sys
+import ektypes, visitor
+
+# The AST built by yacc.py: one class per grammar production.  The
+# nodes use __slots__ to stay small, the checker and the code generator
+# dispatch on their class, to_dict() gives the dict shape that
+# -emit-ast dumps and from_dict() builds the nodes back out of it for
+# -from-ast.  Lists (externs, funcs, stmts, exps, vdecls, tdecls) are
+# plain Python lists; optional parts are None when absent.  Types
+# are ektypes.Type objects, dumped as their source spelling.
+#
+# Both conversions run on visitor.walk, so deep trees do not exhaust the
+# Python stack: every class's build_dict() and build_node() are
+# generators that yield the child nodes (or dicts) they need converted
+# and receive the results back.
+
+class Node():
+    __slots__ = ()
+
+    def to_dict(self):
+        """
+        The dict shape of the tree below this node.
+        """
+        return visitor.walk(self, lambda node: node.build_dict())
+
+def convert_all(items):
+    # the conversions of items, a list of nodes or of dicts
+    results = []
+    for item in items:
+        results.append((yield item))
+    return results
+
+def stmts_dict(stmts):
+    return {"name" : "stmts", "stmts" : (yield from convert_all(stmts))}
+
+def exps_dict(exps):
+    return {"name" : "exps", "exps" : (yield from convert_all(exps))}
+
+def add_exptype(d, exptype):
+    if exptype is not None:
+        d["exptype"] = str(exptype)
+    return d
+
+def stmts_from_dict(d):
+    return (yield from convert_all(d["stmts"]))
+
+def exps_from_dict(d):
+    return (yield from convert_all(d["exps"]))
+
+def set_exptype(node, d):
+    if "exptype" in d:
+        node.exptype = ektypes.parse(d["exptype"])
+    return node
+
+class Prog(Node):
+    __slots__ = ("externs", "funcs")
+
+    def __init__(self, externs, funcs):
+        self.externs = externs
+        self.funcs = funcs
+
+    def build_dict(self):
+        externs = {"name" : "externs"}
+        if self.externs:
+            externs["externs"] = yield from convert_all(self.externs)
+        funcs = {"name" : "funcs", "funcs" : (yield from convert_all(self.funcs))}
+        return {"name" : "prog", "externs" : externs, "funcs" : funcs}
+
+    @classmethod
+    def build_node(cls, d):
+        externs = yield from convert_all(d["externs"].get("externs", []))
+        return cls(externs, (yield from convert_all(d["funcs"]["funcs"])))
+
+class Extern(Node):
+    __slots__ = ("ret_type", "globid", "tdecls")
+
+    def __init__(self, ret_type, globid, tdecls=None):
+        self.ret_type = ret_type
+        self.globid = globid
+        self.tdecls = tdecls
+
+    def build_dict(self):
+        d = {"name" : "extern", "ret_type" : str(self.ret_type), "globid" : self.globid}
+        if self.tdecls is not None:
+            d["tdecls"] = {"name" : "tdecls", "types" : [str(typ) for typ in self.tdecls]}
+        return d
+
+    @classmethod
+    def build_node(cls, d):
+        tdecls = None
+        if "tdecls" in d:
+            tdecls = [ektypes.parse(typ) for typ in d["tdecls"]["types"]]
+        return cls(ektypes.parse(d["ret_type"]), sys.intern(d["globid"]), tdecls)
+
+class Func(Node):
+    __slots__ = ("ret_type", "globid", "vdecls", "blk")
+
+    def __init__(self, ret_type, globid, vdecls, blk):
+        self.ret_type = ret_type
+        self.globid = globid
+        self.vdecls = vdecls
+        self.blk = blk
+
+    def build_dict(self):
+        d = {"name" : "func", "ret_type" : str(self.ret_type), "globid" : self.globid}
+        if self.vdecls is not None:
+            d["vdecls"] = {"name" : "vdecls", "vars" : (yield from convert_all(self.vdecls))}
+        d["blk"] = yield self.blk
+        return d
+
+    @classmethod
+    def build_node(cls, d):
+        vdecls = None
+        if "vdecls" in d:
+            vdecls = yield from convert_all(d["vdecls"]["vars"])
+        return cls(ektypes.parse(d["ret_type"]), sys.intern(d["globid"]), vdecls, (yield d["blk"]))
+
+class VDecl(Node):
+    __slots__ = ("type", "var")
+
+    def __init__(self, type, var):
+        self.type = type
+        self.var = var
+
+    def build_dict(self):
+        return {"node" : "vdecl", "type" : str(self.type), "var" : self.var}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls(ektypes.parse(d["type"]), sys.intern(d["var"]))
+
+# Statements
+
+class Blk(Node):
+    __slots__ = ("stmts",)
+
+    def __init__(self, stmts=None):
+        self.stmts = stmts
+
+    def build_dict(self):
+        d = {"name" : "blk"}
+        if self.stmts is not None:
+            d["contents"] = yield from stmts_dict(self.stmts)
+        return d
+
+    @classmethod
+    def build_node(cls, d):
+        if "contents" in d:
+            return cls((yield from stmts_from_dict(d["contents"])))
+        return cls()
+
+class Ret(Node):
+    __slots__ = ("exp",)
+
+    def __init__(self, exp=None):
+        self.exp = exp
+
+    def build_dict(self):
+        d = {"name" : "ret"}
+        if self.exp is not None:
+            d["exp"] = yield self.exp
+        return d
+
+    @classmethod
+    def build_node(cls, d):
+        if "exp" in d:
+            return cls((yield d["exp"]))
+        return cls()
+
+class VarDeclStmt(Node):
+    __slots__ = ("vdecl", "exp")
+
+    def __init__(self, vdecl, exp):
+        self.vdecl = vdecl
+        self.exp = exp
+
+    def build_dict(self):
+        return {"name" : "vardeclstmt", "vdecl" : (yield self.vdecl), "exp" : (yield self.exp)}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls((yield d["vdecl"]), (yield d["exp"]))
+
+class ExpStmt(Node):
+    __slots__ = ("exp",)
+
+    def __init__(self, exp):
+        self.exp = exp
+
+    def build_dict(self):
+        return {"name" : "expstmt", "exp" : (yield self.exp)}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls((yield d["exp"]))
+
+class While(Node):
+    __slots__ = ("cond", "stmt")
+
+    def __init__(self, cond, stmt):
+        self.cond = cond
+        self.stmt = stmt
+
+    def build_dict(self):
+        return {"name" : "while", "cond" : (yield self.cond), "stmt" : (yield self.stmt)}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls((yield d["cond"]), (yield d["stmt"]))
+
+class If(Node):
+    __slots__ = ("cond", "stmt", "else_stmt")
+
+    def __init__(self, cond, stmt, else_stmt=None):
+        self.cond = cond
+        self.stmt = stmt
+        self.else_stmt = else_stmt
+
+    def build_dict(self):
+        d = {"name" : "if", "cond" : (yield self.cond), "stmt" : (yield self.stmt)}
+        if self.else_stmt is not None:
+            d["else_stmt"] = yield self.else_stmt
+        return d
+
+    @classmethod
+    def build_node(cls, d):
+        cond = yield d["cond"]
+        stmt = yield d["stmt"]
+        else_stmt = None
+        if "else_stmt" in d:
+            else_stmt = yield d["else_stmt"]
+        return cls(cond, stmt, else_stmt)
+
+class Print(Node):
+    __slots__ = ("exp",)
+
+    def __init__(self, exp):
+        self.exp = exp
+
+    def build_dict(self):
+        return {"name" : "print", "exp" : (yield self.exp)}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls((yield d["exp"]))
+
+class PrintSlit(Node):
+    __slots__ = ("string",)
+
+    def __init__(self, string):
+        self.string = string
+
+    def build_dict(self):
+        return {"name" : "printslit", "string" : self.string}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls(d["string"])
+
+# Expressions; the checker fills in exptype
+
+class Binop(Node):
+    __slots__ = ("op", "lhs", "rhs", "exptype")
+
+    def __init__(self, op, lhs, rhs):
+        self.op = op
+        self.lhs = lhs
+        self.rhs = rhs
+        self.exptype = None
+
+    def build_dict(self):
+        d = {"name" : "binop", "op" : self.op, "lhs" : (yield self.lhs), "rhs" : (yield self.rhs)}
+        return add_exptype(d, self.exptype)
+
+    @classmethod
+    def build_node(cls, d):
+        return set_exptype(cls(d["op"], (yield d["lhs"]), (yield d["rhs"])), d)
+
+class Uop(Node):
+    __slots__ = ("op", "exp", "exptype")
+
+    def __init__(self, op, exp):
+        self.op = op
+        self.exp = exp
+        self.exptype = None
+
+    def build_dict(self):
+        return add_exptype({"name" : "uop", "op" : self.op, "exp" : (yield self.exp)}, self.exptype)
+
+    @classmethod
+    def build_node(cls, d):
+        return set_exptype(cls(d["op"], (yield d["exp"])), d)
+
+class Lit(Node):
+    __slots__ = ("value", "exptype")
+
+    def __init__(self, value, exptype):
+        self.value = value
+        self.exptype = exptype
+
+    def build_dict(self):
+        return {"name" : "lit", "value" : self.value, "exptype" : str(self.exptype)}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls(d["value"], ektypes.parse(d["exptype"]))
+
+class VarVal(Node):
+    __slots__ = ("var", "exptype")
+
+    def __init__(self, var):
+        self.var = var
+        self.exptype = None
+
+    def build_dict(self):
+        return add_exptype({"name" : "varval", "var" : self.var}, self.exptype)
+
+    @classmethod
+    def build_node(cls, d):
+        return set_exptype(cls(sys.intern(d["var"])), d)
+
+class Assign(Node):
+    __slots__ = ("var", "exp")
+
+    def __init__(self, var, exp):
+        self.var = var
+        self.exp = exp
+
+    def build_dict(self):
+        return {"name" : "assign", "var" : self.var, "exp" : (yield self.exp)}
+
+    @classmethod
+    def build_node(cls, d):
+        return cls(sys.intern(d["var"]), (yield d["exp"]))
+
+class CastStmt(Node):
+    __slots__ = ("type", "exp", "exptype")
+
+    def __init__(self, type, exp):
+        self.type = type
+        self.exp = exp
+        self.exptype = None
+
+    def build_dict(self):
+        return add_exptype({"name" : "caststmt", "type" : str(self.type), "exp" : (yield self.exp)}, self.exptype)
+
+    @classmethod
+    def build_node(cls, d):
+        return set_exptype(cls(ektypes.parse(d["type"]), (yield d["exp"])), d)
+
+class FuncCall(Node):
+    __slots__ = ("globid", "params", "exptype")
+
+    def __init__(self, globid, params=None):
+        self.globid = globid
+        self.params = params
+        self.exptype = None
+
+    def build_dict(self):
+        d = {"name" : "funccall", "globid" : self.globid}
+        if self.params is not None:
+            d["params"] = yield from exps_dict(self.params)
+        return add_exptype(d, self.exptype)
+
+    @classmethod
+    def build_node(cls, d):
+        params = None
+        if "params" in d:
+            params = yield from exps_from_dict(d["params"])
+        return set_exptype(cls(sys.intern(d["globid"]), params), d)
+
+# The node classes by the name their to_dict() gives
+NODES = {
+    "prog" : Prog,
+    "extern" : Extern,
+    "func" : Func,
+    "vdecl" : VDecl,
+    "blk" : Blk,
+    "ret" : Ret,
+    "vardeclstmt" : VarDeclStmt,
+    "expstmt" : ExpStmt,
+    "while" : While,
+    "if" : If,
+    "print" : Print,
+    "printslit" : PrintSlit,
+    "binop" : Binop,
+    "uop" : Uop,
+    "lit" : Lit,
+    "varval" : VarVal,
+    "assign" : Assign,
+    "caststmt" : CastStmt,
+    "funccall" : FuncCall,
+}
+
+def build_node(d):
+    name = d["node"] if "node" in d else d["name"]
+    return NODES[name].build_node(d)
+
+def from_dict(d):
+    """
+    The node that to_dict() turned into d.
+    """
+    return visitor.walk(d, build_node)
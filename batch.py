@@ -0,0 +1,51 @@
+import csv, os, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# State of a batch worker process: its JIT engine and the loaded program
+_engine = None
+_handle = None
+
+def read_rows(path):
+    """
+    The argument tuples of a batch, one per non-empty CSV row.
+    """
+    with open(path, newline="") as input:
+        return [[field.strip() for field in row] for row in csv.reader(input) if row]
+
+def init_worker(llvm_ir, opt_level):
+    global _engine, _handle
+    import binding
+    _engine = binding.get_engine()
+    _handle = _engine.compile(llvm_ir, opt_level)
+
+def run_row(args):
+    """
+    Run the worker's program on one argument tuple, returning the value
+    run() returned and everything the program printed.  A row that ends
+    with a runtime error has exit code 1 and the error after its output.
+    """
+    import codeGen, binding
+    with tempfile.TemporaryFile() as output:
+        error = ""
+        try:
+            exitcode = _engine.run(_handle, args=args, output_fd=output.fileno())
+        except codeGen.ArgumentError as e:
+            return 1, e.message + "\n"
+        except binding.ProgramError as e:
+            exitcode, error = 1, e.message + "\n"
+        output.seek(0)
+        return exitcode, output.read().decode("utf8", "replace") + error
+
+# The function called by ekcc.py
+def run_batch(llvm_ir, rows, opt_level=0, jobs=None):
+    """
+    Run the program compiled from llvm_ir (generated in runtime-argument
+    mode) once per argument tuple in rows, spread over jobs worker
+    processes that each JIT-compile the program once.  Returns
+    (exitcode, output) pairs in the order of rows.
+    """
+    jobs = min(jobs or os.cpu_count() or 1, max(len(rows), 1))
+    chunksize = max(1, len(rows) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(str(llvm_ir), opt_level)) as pool:
+        return list(pool.map(run_row, rows, chunksize=chunksize))
@@ -0,0 +1,124 @@
+import argparse, json, os, platform, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gen
+import yacc, codeGen, binding, timing
+import llvmlite.binding as llvm
+
+# The workloads: generator settings that each stress one part of the
+# pipeline.  -scale multiplies every size.
+WORKLOADS = {
+    "funcs":  dict(funcs=400, depth=4, stmts=4, locals=4, loop=1, prints=1),
+    "deep":   dict(funcs=1, depth=1500, stmts=1, locals=1, loop=1, prints=1),
+    "stmts":  dict(funcs=1, depth=1, stmts=4000, locals=8, loop=1, prints=1),
+    "locals": dict(funcs=1, depth=1, stmts=1, locals=3000, loop=1, prints=1),
+    "loop":   dict(funcs=4, depth=8, stmts=8, locals=4, loop=2000000, prints=1),
+    "print":  dict(funcs=1, depth=1, stmts=1, locals=1, loop=1, prints=500000),
+}
+
+# A phase only counts as regressed when it is this much slower in
+# absolute terms too, so noise in very short phases is ignored
+MIN_REGRESSION = 0.005
+
+def scaled(settings, scale):
+    return {knob: max(1, int(value * scale)) for knob, value in settings.items()}
+
+def measure(source, opt_level, engine):
+    """
+    Compile and run source once, returning the seconds spent in every
+    phase (see timing.py).
+    """
+    with timing.record() as recorder:
+        ast, err_message = yacc.parse(source)
+        if err_message is not None:
+            raise ValueError(err_message)
+        mod = codeGen.generate_code(ast, None)
+        handle = engine.compile(mod, opt_level)
+        try:
+            with open(os.devnull, "w") as devnull:
+                engine.run(handle, args=["1"], output_fd=devnull.fileno())
+        finally:
+            engine.release(handle)
+    phases = {}
+    for name, wall, cpu, peak in recorder.phases:
+        phases[name] = phases.get(name, 0.0) + wall
+    phases["total"] = sum(wall for _, wall, _, _ in recorder.phases)
+    return phases
+
+def run_benchmarks(workloads, opt_levels, repeat, scale):
+    # No object cache: every compile goes through LLVM code generation
+    engine = binding.JITEngine(None)
+    results = {}
+    for name in workloads:
+        source = gen.generate(**scaled(WORKLOADS[name], scale))
+        results[name] = {}
+        for opt_level in opt_levels:
+            runs = [measure(source, opt_level, engine) for _ in range(repeat)]
+            # the fastest run is the least disturbed by the machine
+            best = {phase: min(run[phase] for run in runs) for phase in runs[0]}
+            results[name]["O%d" % opt_level] = best
+            print("%-8s -O%d %s" % (name, opt_level, "  ".join("%s %.1fms" % (phase, seconds * 1000)
+                                                             for phase, seconds in best.items())),
+                  file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    The phases of results that are more than threshold (a fraction)
+    slower than in baseline, as (workload, level, phase, old, new).
+    """
+    regressions = []
+    for name, levels in sorted(results.items()):
+        for level, phases in sorted(levels.items()):
+            old_phases = baseline.get(name, {}).get(level, {})
+            for phase, new in sorted(phases.items()):
+                old = old_phases.get(phase)
+                if old is not None and new > old * (1 + threshold) and new - old > MIN_REGRESSION:
+                    regressions.append((name, level, phase, old, new))
+    return regressions
+
+parser = argparse.ArgumentParser(prog=sys.argv[0],
+                                 description="Time the compiler phases on generated programs",
+                                 usage="python3 bench/bench.py [-w <workload>]... [-O <level>]... [-r <repeat>] [-scale <factor>] [-o <results.json>] [-baseline <baseline.json>] [-threshold <fraction>]",
+                                 add_help=False)
+parser.add_argument("-h", action="help", help="show this help message and exit")
+parser.add_argument("-w", action="append", choices=sorted(WORKLOADS), metavar="workload",
+                    help="workload to run, may be repeated (default: all of %s)" % ", ".join(sorted(WORKLOADS)))
+parser.add_argument("-O", action="append", type=int, choices=range(4), dest="opt_levels", metavar="level",
+                    help="optimization level, may be repeated (default: 0 1 2 3)")
+parser.add_argument("-r", type=int, default=3, metavar="repeat", help="runs per measurement, the fastest counts (default 3)")
+parser.add_argument("-scale", type=float, default=1.0, metavar="factor", help="multiply the workload sizes")
+parser.add_argument("-o", metavar="results.json", help="write the results as JSON (use it as a later -baseline)")
+parser.add_argument("-baseline", metavar="baseline.json", help="fail if a phase is slower than in this earlier result")
+parser.add_argument("-threshold", type=float, default=0.25, metavar="fraction", help="allowed slowdown against the baseline (default 0.25)")
+
+def main(argv):
+    options = parser.parse_args(argv)
+    workloads = options.w or sorted(WORKLOADS)
+    opt_levels = options.opt_levels or [0, 1, 2, 3]
+    if options.baseline:
+        with open(options.baseline) as input:
+            baseline = json.load(input)
+        if baseline.get("scale") != options.scale:
+            parser.error("the baseline was measured with -scale %s" % baseline.get("scale"))
+    results = run_benchmarks(workloads, opt_levels, options.r, options.scale)
+    report = {"python": platform.python_version(),
+              "llvm": ".".join(map(str, llvm.llvm_version_info)),
+              "scale": options.scale,
+              "results": results}
+    if options.o:
+        with open(options.o, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write("\n")
+    if options.baseline:
+        regressions = compare(results, baseline["results"], options.threshold)
+        for name, level, phase, old, new in regressions:
+            print("regression: %s -%s %s %.1fms -> %.1fms" % (name, level, phase, old * 1000, new * 1000))
+        if regressions:
+            return 1
+        print("no regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,82 @@
+import argparse, sys
+
+# Generator of large, valid ek programs for the benchmarks.  Each knob
+# stresses one part of the compiler or of the generated code:
+#
+#   funcs    number of helper functions called from run
+#   depth    nesting depth of the expression in every helper
+#   stmts    length of the statement list in every helper
+#   locals   local variables declared in every helper
+#   loop     iterations of the hot while loop in run
+#   prints   lines printed by run
+#
+# Only +, - and * are generated, so no program divides by zero.
+
+def nested_expression(depth):
+    # (((($a + 1) * $b) - 2) + ...) nested depth times
+    ops = ["+", "*", "-"]
+    text = "$a"
+    for level in range(depth):
+        operand = "$b" if level % 3 == 1 else str(level % 7 + 1)
+        text = "(" + text + " " + ops[level % 3] + " " + operand + ")"
+    return text
+
+def helper(index, depth, stmts, local_count):
+    lines = ["def int f%d(int $a, int $b) {" % index]
+    for local in range(local_count):
+        lines.append("    int $v%d = $a + %d;" % (local, local))
+    lines.append("    int $r = %s;" % nested_expression(depth))
+    for stmt in range(stmts):
+        if local_count:
+            lines.append("    $r = $r + $v%d;" % (stmt % local_count))
+        else:
+            lines.append("    $r = $r + %d;" % (stmt % 5))
+    lines.append("    return $r;")
+    lines.append("}")
+    return "\n".join(lines)
+
+def generate(funcs=1, depth=1, stmts=1, locals=1, loop=1, prints=1):
+    """
+    The source text of a program with the given sizes.
+    """
+    parts = ["extern int arg(int);", ""]
+    for index in range(funcs):
+        parts.append(helper(index, depth, stmts, locals))
+        parts.append("")
+    body = ["def int run() {",
+            "    int $i = 0;",
+            "    int $acc = arg(0);",
+            "    while ($i < %d) {" % loop]
+    for index in range(funcs):
+        body.append("        $acc = f%d($i, $acc);" % index)
+    body += ["        $i = $i + 1;",
+             "    }",
+             "    int $j = 0;",
+             "    while ($j < %d) {" % prints,
+             "        print $j;",
+             '        print "row";',
+             "        $j = $j + 1;",
+             "    }",
+             "    print $acc;",
+             "    return 0;",
+             "}"]
+    parts.append("\n".join(body))
+    return "\n".join(parts) + "\n"
+
+parser = argparse.ArgumentParser(prog=sys.argv[0],
+                                 description="Generate a large ek program",
+                                 usage="python3 bench/gen.py [-funcs N] [-depth N] [-stmts N] [-locals N] [-loop N] [-prints N] [-o <output-file>]",
+                                 add_help=False)
+parser.add_argument("-h", action="help", help="show this help message and exit")
+for knob in ["funcs", "depth", "stmts", "locals", "loop", "prints"]:
+    parser.add_argument("-" + knob, type=int, default=1, metavar="N")
+parser.add_argument("-o", default=None, metavar="output-file", help="write the program to output-file instead of stdout")
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    source = generate(options.funcs, options.depth, options.stmts, options.locals, options.loop, options.prints)
+    if options.o is None:
+        sys.stdout.write(source)
+    else:
+        with open(options.o, "w") as output:
+            output.write(source)
@@ -1,6 +1,8 @@
 from __future__ import print_function
 
-from ctypes import CFUNCTYPE, c_int, c_float
+from ctypes import CFUNCTYPE, CDLL, POINTER, addressof, byref, c_int, c_float, c_void_p
+import contextlib, os, shutil, subprocess, sys, tempfile, threading
+import cache, codeGen, runtime, timing
 
 import llvmlite.binding as llvm
 
@@ -9,43 +11,537 @@ llvm.initialize()
 llvm.initialize_native_target()
 llvm.initialize_native_asmprinter()  # yes, even this one
 
-def create_execution_engine():
+# The C runtime of this process, which JIT-compiled code prints through
+libc = CDLL(None)
+
+def flush_stdio():
+    """
+    Flush Python's and the C library's stdio buffers.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    libc.fflush(None)
+
+@contextlib.contextmanager
+def redirected_stdio(fds):
+    """
+    Point the process file descriptors given as keys of fds (e.g. 1 for
+    stdout) at the descriptors given as values while the block runs,
+    so both Python and JIT-compiled code write to them.
+    """
+    flush_stdio()
+    saved = {fd: os.dup(fd) for fd in fds}
+    try:
+        for fd, target in fds.items():
+            os.dup2(target, fd)
+        yield
+    finally:
+        flush_stdio()
+        for fd, orig in saved.items():
+            os.dup2(orig, fd)
+            os.close(orig)
+
+# Inliner thresholds used for -O1, -O2 and -O3 (the values clang uses)
+INLINE_THRESHOLDS = {1: 75, 2: 225, 3: 275}
+
+def host_cpu_features():
+    try:
+        return llvm.get_host_cpu_features().flatten()
+    except RuntimeError:
+        return ""
+
+def create_target_machine(aot=False):
+    """
+    Create a target machine representing the host CPU, including
+    the instruction set extensions it supports.  With aot, the machine
+    generates position independent code for object files instead.
+    """
+    target = llvm.Target.from_default_triple()
+    if aot:
+        return target.create_target_machine(cpu=llvm.get_host_cpu_name(), features=host_cpu_features(),
+                                            reloc="pic", codemodel="default")
+    return target.create_target_machine(cpu=llvm.get_host_cpu_name(), features=host_cpu_features())
+
+def create_execution_engine(target_machine):
     """
     Create an ExecutionEngine suitable for JIT code generation on
     the host CPU.  The engine is reusable for an arbitrary number of
     modules.
     """
-    # Create a target machine representing the host
-    target = llvm.Target.from_default_triple()
-    target_machine = target.create_target_machine()
-    # And an execution engine with an empty backing module
+    # An execution engine with an empty backing module
     backing_mod = llvm.parse_assembly("")
     engine = llvm.create_mcjit_compiler(backing_mod, target_machine)
     return engine
 
 
-def compile_ir(engine, llvm_ir):
+def pass_manager_builder(opt_level):
+    pmb = llvm.create_pass_manager_builder()
+    pmb.opt_level = opt_level
+    pmb.size_level = 0
+    pmb.inlining_threshold = INLINE_THRESHOLDS[opt_level]
+    pmb.loop_vectorize = opt_level >= 3
+    pmb.slp_vectorize = opt_level >= 3
+    return pmb
+
+def optimize_functions(mod, target_machine, opt_level):
+    """
+    The per-function half of optimize(): the cleanups that look at one
+    function at a time.
+    """
+    if opt_level <= 0:
+        return mod
+    fpm = llvm.create_function_pass_manager(mod)
+    target_machine.add_analysis_passes(fpm)
+    pass_manager_builder(opt_level).populate(fpm)
+    fpm.initialize()
+    for func in mod.functions:
+        fpm.run(func)
+    fpm.finalize()
+    return mod
+
+def optimize_module(mod, target_machine, opt_level):
+    """
+    The whole-module half of optimize(), with the inliner.
+    """
+    if opt_level <= 0:
+        return mod
+    pm = llvm.create_module_pass_manager()
+    target_machine.add_analysis_passes(pm)
+    pass_manager_builder(opt_level).populate(pm)
+    pm.run(mod)
+    return mod
+
+def optimize(mod, target_machine, opt_level):
+    """
+    Run the standard LLVM pipeline for the given -O level over the
+    module in place.  Level 0 leaves the module untouched.
+
+    From -O1 on the pipeline promotes allocas to registers (SROA, the
+    superset of mem2reg), runs instcombine, CFG simplification, the
+    loop passes and the inliner; -O2 adds GVN and -O3 the vectorizers.
+    """
+    # Per-function cleanups first, so the inliner sees small functions
+    optimize_functions(mod, target_machine, opt_level)
+    return optimize_module(mod, target_machine, opt_level)
+
+def compile_ir(target_machine, llvm_ir, opt_level=0):
     """
-    Compile the LLVM IR string with the given engine.
-    The compiled module object is returned.
+    Parse and verify the LLVM IR string for the given target machine,
+    optimizing it at opt_level.  The LLVM module object is returned.
     """
     # Create a LLVM module object from the IR
-    mod = llvm.parse_assembly(str(llvm_ir))
-    mod.verify()
-    # Now add the module and make sure it is ready for execution
-    engine.add_module(mod)
-    engine.finalize_object()
-    engine.run_static_constructors()
-    return str(mod)
-
-# The function called by ekcc
-def compile_and_execute(llvm_ir):
-    engine = create_execution_engine()
-    mod = compile_ir(engine, llvm_ir)
-
-    # Look up the function pointer (a Python int)
-    func_ptr = engine.get_function_address("run")
-    # Run the function via ctypes
-    cfunc = CFUNCTYPE(c_int)(func_ptr)
-    res = cfunc()
+    with timing.phase("ir_parse_verify"):
+        mod = llvm.parse_assembly(str(llvm_ir))
+        mod.triple = target_machine.triple
+        mod.data_layout = str(target_machine.target_data)
+        mod.verify()
+    with timing.phase("optimize"):
+        optimize(mod, target_machine, opt_level)
     return mod
+
+class ObjectCache():
+    """
+    An on-disk cache of the object code MCJIT generates, so modules
+    already compiled once skip LLVM code generation.  Entries are
+    named after the module name, which JITEngine sets to a hash of the
+    optimized IR, target and -O level; the least recently used entries
+    are evicted once the cache holds more than max_bytes.
+    """
+    suffix = ".o"
+
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.suffix)
+
+    def load(self, name):
+        path = self.path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time records the last use for eviction
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def store(self, name, buffer):
+        # Also called from MCJIT's object cache hook: a cache that is
+        # read-only or full is simply not written
+        try:
+            tmp_dir = cache.private_dir(self.directory)
+            tmp_path = os.path.join(tmp_dir, "entry" + self.suffix)
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(buffer)
+                cache.publish(tmp_path, self.path(name))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                os.rmdir(tmp_dir)
+            self.evict()
+        except OSError:
+            return
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def create_object_cache():
+    """
+    The object cache configured by the environment, or None when it is
+    disabled with EKCC_NO_OBJECT_CACHE or cannot be created.
+    EKCC_OBJECT_CACHE_SIZE bounds its size in bytes.
+    """
+    if os.environ.get("EKCC_NO_OBJECT_CACHE"):
+        return None
+    directory = cache.cache_dir("objects")
+    if directory is None:
+        return None
+    max_bytes = os.environ.get("EKCC_OBJECT_CACHE_SIZE")
+    if max_bytes:
+        return ObjectCache(directory, int(max_bytes))
+    return ObjectCache(directory)
+
+class ProgramError(Exception):
+    """
+    A JIT-compiled program that ended with a runtime error, e.g. a cint
+    overflow; message is the error line ahead-of-time code writes to
+    stderr before it exits with status 1.
+    """
+    def __init__(self, m):
+        self.message = m
+
+class CompiledModule():
+    """
+    A handle on a module loaded into a JITEngine.  ir is the optimized
+    IR text as the program was written; the symbols the module defines
+    carry a ".<key>" suffix inside the engine so that any number of
+    programs can be loaded side by side.
+    """
+    def __init__(self, key, module, ir):
+        self.key = key
+        self.module = module
+        self.ir = ir
+        self.refs = 1
+
+    def symbol(self, name):
+        return name + "." + self.key
+
+class JITEngine():
+    """
+    A long-lived MCJIT engine with one target machine for the host CPU.
+    Programs are added with compile() (or add() once optimized) and
+    removed with release(); compiling the same program twice returns
+    the loaded module.  With an object_cache, code generation is
+    skipped for programs compiled before, in this process or an
+    earlier one.
+    """
+    def __init__(self, object_cache=None):
+        self.target_machine = create_target_machine()
+        self.engine = create_execution_engine(self.target_machine)
+        self.modules = {}
+        self.lock = threading.RLock()
+        self.object_cache = object_cache
+        if object_cache is not None:
+            self.engine.set_object_cache(self.store_object, self.load_object)
+        # Everything besides the IR and -O level that shapes the code
+        self.target_key = cache.digest(self.target_machine.triple,
+                                       llvm.get_host_cpu_name(),
+                                       host_cpu_features(),
+                                       llvm.llvm_version_info)
+
+    def compile(self, llvm_ir, opt_level=0):
+        return self.add(compile_ir(self.target_machine, llvm_ir, opt_level), opt_level)
+
+    def add(self, mod, opt_level=0):
+        """
+        Load mod, an LLVM module already optimized at opt_level for
+        this engine's target machine.
+        """
+        ir = str(mod)
+        key = cache.digest(ir, self.target_key, opt_level)[:16]
+        with self.lock:
+            if key in self.modules:
+                handle = self.modules[key]
+                handle.refs += 1
+                return handle
+            handle = CompiledModule(key, mod, ir)
+            # Keep the symbols of different programs apart in the engine
+            for value in list(mod.functions) + list(mod.global_variables):
+                if not value.is_declaration:
+                    value.name = handle.symbol(value.name)
+            mod.name = key
+            self.modules[key] = handle
+            # Now add the module and make sure it is ready for execution
+            with timing.phase("finalize"):
+                self.engine.add_module(mod)
+                self.engine.finalize_object()
+                self.engine.run_static_constructors()
+            return handle
+
+    # Object cache hooks; only programs compiled by this engine are cached,
+    # not the engine's own empty backing module
+    def load_object(self, module):
+        if module.name in self.modules:
+            return self.object_cache.load(module.name)
+        return None
+
+    def store_object(self, module, buffer):
+        if module.name in self.modules:
+            self.object_cache.store(module.name, buffer)
+
+    def set_global(self, handle, name, ctype, value):
+        # Programs that never call arg/argf do not define the tables
+        address = self.engine.get_global_value_address(handle.symbol(name))
+        if address:
+            ctype.from_address(address).value = value
+
+    def set_args(self, handle, args):
+        """
+        Point the argument tables of a program compiled in runtime-argument
+        mode at args; the returned arrays must outlive the run.  Only
+        the tables the program has are filled, so the arguments of a
+        program that never reads them are not looked at.  Raises
+        codeGen.ArgumentError for an argument arg/argf cannot read.
+        """
+        tables = []
+        for name, ctype, convert in [(codeGen.ARGV_INT, c_int, codeGen.int_arg),
+                                     (codeGen.ARGV_FLOAT, c_float, codeGen.float_arg)]:
+            address = self.engine.get_global_value_address(handle.symbol(name))
+            if address:
+                table = (ctype * len(args))(*[convert(arg) for arg in args])
+                c_void_p.from_address(address).value = addressof(table)
+                tables.append(table)
+        self.set_global(handle, codeGen.ARGC, c_int, len(args))
+        return tables
+
+    def run(self, handle, entry="run", args=None, output_fd=1):
+        """
+        Call entry and return its result.  args are the command-line
+        arguments read by arg/argf of a program compiled in
+        runtime-argument mode.  The program prints to output_fd, and
+        its buffered output is flushed when entry returns.  Raises
+        ProgramError when a cint overflow ends run().  A loaded
+        program must not be run by two threads at once.
+        """
+        if args is not None:
+            # Keeps the argument arrays alive until the call returns
+            tables = self.set_args(handle, args)
+        self.set_global(handle, runtime.OUT_FD, c_int, output_fd)
+        # Look up the function pointers (Python ints); run() is called
+        # through ek_run_guarded, which returns when a cint overflows
+        guarded_ptr = 0
+        if entry == "run":
+            guarded_ptr = self.engine.get_function_address(handle.symbol(runtime.RUN_GUARDED))
+        func_ptr = self.engine.get_function_address(handle.symbol(entry))
+        flush_ptr = self.engine.get_function_address(handle.symbol(runtime.FLUSH))
+        # Whatever the host printed goes out before the program's output
+        flush_stdio()
+        # Run the function via ctypes
+        with timing.phase("run"):
+            try:
+                if not guarded_ptr:
+                    return CFUNCTYPE(c_int)(func_ptr)()
+                result = c_int()
+                if CFUNCTYPE(c_int, POINTER(c_int))(guarded_ptr)(byref(result)):
+                    raise ProgramError(runtime.OVERFLOW_MESSAGE.rstrip("\n"))
+                return result.value
+            finally:
+                if flush_ptr:
+                    CFUNCTYPE(None)(flush_ptr)()
+
+    def release(self, handle):
+        with self.lock:
+            handle.refs -= 1
+            if handle.refs == 0:
+                self.engine.remove_module(handle.module)
+                del self.modules[handle.key]
+
+_engine = None
+
+def get_engine():
+    """
+    The JITEngine shared by everything in this process.
+    """
+    global _engine
+    if _engine is None:
+        _engine = JITEngine(create_object_cache())
+    return _engine
+
+# The function called by ekcc; args are passed to arg/argf at run time
+def compile_and_execute(llvm_ir, opt_level=0, args=None):
+    engine = get_engine()
+    handle = engine.compile(llvm_ir, opt_level)
+    try:
+        engine.run(handle, args=args)
+    finally:
+        engine.release(handle)
+    return handle.ir
+
+# The C entry point of executables: it hands argv to arg/argf through
+# the argument tables (when the program has them) and exits with the
+# value run() returns
+MAIN_STUB = r"""
+#include <ctype.h>
+#include <errno.h>
+#include <limits.h>
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+extern int run(void);
+extern void ek_flush(void);
+extern int ek_argc __attribute__((weak));
+extern int *ek_argv_int __attribute__((weak));
+extern float *ek_argv_float __attribute__((weak));
+
+/* Python's int() and float() take no hexadecimal, strtod does */
+static int is_hex(const char *arg) {
+    return strpbrk(arg, "xX") != NULL;
+}
+
+/* the whole argument was read, up to trailing white space */
+static int at_end(const char *end) {
+    while (isspace((unsigned char) *end))
+        end++;
+    return *end == '\0';
+}
+
+/* read like codeGen.int_arg: an integer, or a number truncated */
+static const char *int_arg(const char *arg, int *value) {
+    char *end;
+    long l;
+    double d;
+    errno = 0;
+    l = strtol(arg, &end, 10);
+    if (end != arg && at_end(end)) {
+        d = errno == ERANGE ? (l < 0 ? -HUGE_VAL : HUGE_VAL) : (double) l;
+    } else {
+        d = strtod(arg, &end);
+        if (end == arg || !at_end(end) || !isfinite(d) || is_hex(arg))
+            return "is not a number";
+    }
+    /* the cast truncates toward zero */
+    if (d <= INT_MIN - 1.0 || d >= INT_MAX + 1.0)
+        return "does not fit in an int";
+    *value = (int) d;
+    return NULL;
+}
+
+/* read like codeGen.float_arg */
+static const char *float_arg(const char *arg, float *value) {
+    char *end;
+    *value = strtof(arg, &end);
+    if (end == arg || !at_end(end) || is_hex(arg))
+        return "is not a number";
+    return NULL;
+}
+
+int main(int argc, char **argv) {
+    int i, n = argc - 1;
+    const char *error = NULL;
+    int *ints = malloc(sizeof(int) * (n + 1));
+    float *floats = malloc(sizeof(float) * (n + 1));
+    /* the tables exist only if the program calls arg or argf, and
+       only those arguments are read */
+    for (i = 0; i < n; i++) {
+        if (&ek_argv_int)
+            error = int_arg(argv[i + 1], &ints[i]);
+        if (!error && &ek_argv_float)
+            error = float_arg(argv[i + 1], &floats[i]);
+        if (error) {
+            fprintf(stderr, "error: argument '%s' %s\n", argv[i + 1], error);
+            return 1;
+        }
+    }
+    if (&ek_argc)
+        ek_argc = n;
+    if (&ek_argv_int)
+        ek_argv_int = ints;
+    if (&ek_argv_float)
+        ek_argv_float = floats;
+    i = run();
+    ek_flush();
+    return i;
+}
+"""
+
+_target_machines = {}
+
+def get_target_machine(aot=False):
+    """
+    The host target machine (see create_target_machine) shared by the
+    ahead-of-time compilations of this process.
+    """
+    if aot not in _target_machines:
+        _target_machines[aot] = create_target_machine(aot)
+    return _target_machines[aot]
+
+def optimize_ir(llvm_ir, opt_level=0):
+    """
+    The LLVM IR string optimized at opt_level for the host, as text.
+    """
+    return str(compile_ir(get_target_machine(), llvm_ir, opt_level))
+
+def emit_object(llvm_ir, opt_level=0):
+    """
+    Compile the LLVM IR string ahead of time into an object file for
+    the host, returned as bytes.
+    """
+    target_machine = get_target_machine(aot=True)
+    mod = compile_ir(target_machine, llvm_ir, opt_level)
+    with timing.phase("emit"):
+        return target_machine.emit_object(mod)
+
+def emit_assembly(llvm_ir, opt_level=0):
+    """
+    Compile the LLVM IR string ahead of time into host assembly text.
+    """
+    target_machine = get_target_machine(aot=True)
+    mod = compile_ir(target_machine, llvm_ir, opt_level)
+    with timing.phase("emit"):
+        return target_machine.emit_assembly(mod)
+
+def link_executable(llvm_ir, output_file, opt_level=0):
+    """
+    Compile the LLVM IR string and link it with MAIN_STUB into a native
+    executable at output_file, using $CC (default cc) as the linker.
+    The program should be generated in runtime-argument mode so that it
+    reads arg/argf from its command line.
+    """
+    obj = emit_object(llvm_ir, opt_level)
+    tmp_dir = tempfile.mkdtemp(prefix="ekcc-")
+    try:
+        obj_path = os.path.join(tmp_dir, "prog.o")
+        main_path = os.path.join(tmp_dir, "main.c")
+        with open(obj_path, "wb") as f:
+            f.write(obj)
+        with open(main_path, "w") as f:
+            f.write(MAIN_STUB)
+        cc = os.environ.get("CC", "cc")
+        with timing.phase("link"):
+            proc = subprocess.run([cc, "-O2", "-o", output_file, main_path, obj_path],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.returncode != 0:
+            raise RuntimeError("%s failed to link %s:\n%s" % (cc, output_file, proc.stdout.decode("utf8", "replace")))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,55 @@
+import os, hashlib, tempfile
+
+# Bump whenever the layout or the contents of the cache change
+CACHE_VERSION = 2
+
+def cache_root():
+    """
+    The root of the ekcc cache: $EKCC_CACHE_DIR, or ekcc/ under
+    $XDG_CACHE_HOME (~/.cache by default).
+    """
+    root = os.environ.get("EKCC_CACHE_DIR")
+    if not root:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        root = os.path.join(base, "ekcc")
+    return os.path.join(root, "v%d" % CACHE_VERSION)
+
+def cache_dir(name):
+    """
+    Return the cache subdirectory name, creating it if needed.
+    None is returned when the cache cannot be created, in which case
+    callers fall back to building everything in memory.
+    """
+    path = os.path.join(cache_root(), name)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+def digest(*parts):
+    """
+    A stable hex digest of the given strings, used as cache keys.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf8"))
+        h.update(b"\0")
+    return h.hexdigest()[:32]
+
+def private_dir(directory):
+    """
+    A fresh scratch directory next to the cache entries, so finished
+    entries can be published with an atomic rename.
+    """
+    return tempfile.mkdtemp(prefix=".tmp-", dir=directory)
+
+def publish(tmp_path, path):
+    """
+    Atomically move a finished entry into place.  Entries are never
+    rewritten once published, so readers never see a partial file.
+    """
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
@@ -1,12 +1,22 @@
 from llvmlite import ir
 import llvmlite.binding as llvm
 import ctypes
+from collections import ChainMap
+import visitor, astnodes, ektypes, runtime, timing
 
 def load_var(builder, pointer):
     while pointer.type.is_pointer:
         pointer = builder.load(pointer)
     return pointer
 
+def to_bool(builder, value):
+    # the condition value != 0 of an int or float value
+    if value.type == i1:
+        return value
+    if value.type == f32:
+        return builder.fcmp_unordered("!=", value, ir.Constant(f32, 0.0))
+    return builder.icmp_signed("!=", value, ir.Constant(value.type, 0))
+
 def get_pointer(builder, pointer):
     if not pointer.type.is_pointer:
         return pointer
@@ -16,409 +26,554 @@ def get_pointer(builder, pointer):
         next_pointer = builder.load(pointer)
     return pointer
 
+# llvmlite types used by the generated code, built once
+i1 = ektypes.BOOL.ir_type
+i8 = ir.IntType(8)
+i32 = ektypes.INT.ir_type
+f32 = ektypes.FLOAT.ir_type
+f64 = ir.DoubleType()
+
 def generate_type(typ):
-    if typ == "int":
-        return ir.IntType(32)
-    elif typ == "float":
-        return ir.FloatType()
-    elif typ == "void":
-        return ir.VoidType()
-    elif typ == "bool":
-        return ir.IntType(1)
-    elif "ref" in typ:
-        if "int" in typ:
-            return ir.PointerType(ir.IntType(32))
-        elif "float" in typ:
-            return ir.PointerType(ir.FloatType())
-        elif "bool" in typ:
-            return ir.PointerType(ir.IntType(1))
-    elif typ == "slit":
-        return ir.PointerType(ir.IntType(8))
+    return typ.ir_type
 
 def generate_slit(string):
-    c_str_val = ir.Constant(ir.ArrayType(ir.IntType(8), len(string)), bytearray(string.encode("utf8")))
+    data = bytearray(string.encode("utf8"))
+    c_str_val = ir.Constant(ir.ArrayType(i8, len(data)), data)
     return c_str_val
 
-def generate_arg(ast, module, undefined_args):
-    # Declare function
-    fnty = ir.FunctionType(generate_type("int"), [generate_type("int")])
-    func = ir.Function(module, fnty, name = "arg")
-    entry = func.append_basic_block("entry")
-    builder = ir.IRBuilder(entry)
-
-    # dummy switch else, switch end
-    bbelse = builder.append_basic_block("switch.else")
-    bbend = builder.append_basic_block("switch.end")
-    switch = builder.switch(func.args[0], bbelse)
-    with builder.goto_block(bbelse):
-        builder.ret(ir.Constant(generate_type("int"), 0))
-    with builder.goto_block(bbend):
-        builder.ret(ir.Constant(generate_type("int"), 0))
-
-    # build switch blocks
-    for idx, arg in enumerate(undefined_args):
-        bbi = builder.append_basic_block("switch.%d" % idx)
-        switch.add_case(idx, bbi)
-        with builder.goto_block(bbi):
-            builder.ret(ir.Constant(generate_type("int"), int(arg)))
-
-def generate_argf(ast, module, undefined_args):
-    # Declare function
-    fnty = ir.FunctionType(generate_type("float"), [generate_type("int")])
-    func = ir.Function(module, fnty, name = "argf")
-    entry = func.append_basic_block("entry")
-    builder = ir.IRBuilder(entry)
-
-    # dummy switch else, switch end
-    bbelse = builder.append_basic_block("switch.else")
-    bbend = builder.append_basic_block("switch.end")
-    switch = builder.switch(func.args[0], bbelse)
-    with builder.goto_block(bbelse):
-        builder.ret(ir.Constant(generate_type("float"), float(0)))
-    with builder.goto_block(bbend):
-        builder.ret(ir.Constant(generate_type("float"), float(0)))
-
-    # build switch blocks
-    for idx, arg in enumerate(undefined_args):
-        bbi = builder.append_basic_block("switch.%d" % idx)
-        switch.add_case(idx, bbi)
-        with builder.goto_block(bbi):
-            builder.ret(ir.Constant(generate_type("float"), float(arg)))
+# Globals through which the host passes the command-line arguments to
+# arg/argf in runtime-argument mode (see binding.JITEngine.run)
+ARGC = "ek_argc"
+ARGV_INT = "ek_argv_int"
+ARGV_FLOAT = "ek_argv_float"
+
+def get_or_add_global(module, name, typ, initializer):
+    try:
+        return module.get_global(name)
+    except KeyError:
+        gv = ir.GlobalVariable(module, typ, name=name)
+        gv.initializer = initializer
+        return gv
+
+class ArgumentError(Exception):
+    """
+    A command-line argument that arg or argf cannot read.
+    """
+    def __init__(self, m):
+        self.message = m
+
+def int_arg(arg):
+    """
+    The value of a command-line argument as read by arg(): an integer,
+    or a number truncated toward zero.  The main of executables (see
+    binding.MAIN_STUB) reads arguments the same way.
+    """
+    try:
+        value = int(arg)
+    except ValueError:
+        try:
+            value = int(float(arg))
+        except (ValueError, OverflowError):
+            raise ArgumentError("error: argument %r is not a number" % arg)
+    if not -2**31 <= value < 2**31:
+        raise ArgumentError("error: argument %r does not fit in an int" % arg)
+    return value
+
+def float_arg(arg):
+    """
+    The value of a command-line argument as read by argf().
+    """
+    try:
+        return float(arg)
+    except ValueError:
+        raise ArgumentError("error: argument %r is not a number" % arg)
+
+def new_arg_function(module, name, elem_type):
+    # arg and argf are internal and always inlined, so arg(i) in the
+    # program becomes a bounds check and a load, folded for constant i
+    func = ir.Function(module, ir.FunctionType(elem_type, [i32]), name=name)
+    func.linkage = "internal"
+    func.attributes.add("alwaysinline")
+    func.attributes.add("nounwind")
+    return func
+
+def generate_table_load(func, builder, count, table):
+    # returns table[i], or 0 when i is out of range
+    inbounds = func.append_basic_block("inbounds")
+    outofbounds = func.append_basic_block("outofbounds")
+    index = func.args[0]
+    builder.cbranch(builder.icmp_unsigned("<", index, count), inbounds, outofbounds)
+    with builder.goto_block(inbounds):
+        builder.ret(builder.load(builder.gep(table, [index])))
+    with builder.goto_block(outofbounds):
+        builder.ret(ir.Constant(func.return_value.type, 0))
+
+def generate_static_arg(module, name, elem_type, values):
+    # arg(i) reads a constant table of the arguments given at compile time
+    table_type = ir.ArrayType(elem_type, len(values))
+    table = ir.GlobalVariable(module, table_type, name=name + "_table")
+    table.linkage = "internal"
+    table.global_constant = True
+    table.unnamed_addr = True
+    table.initializer = ir.Constant(table_type, [ir.Constant(elem_type, value) for value in values])
+    func = new_arg_function(module, name, elem_type)
+    builder = ir.IRBuilder(func.append_basic_block("entry"))
+    zero = ir.Constant(i32, 0)
+    generate_table_load(func, builder, ir.Constant(i32, len(values)), table.gep([zero, zero]))
+
+def generate_runtime_arg(module, name, table_name, elem_type):
+    # arg(i) loads the i-th entry of the argument table set by the host,
+    # or returns 0 when i is out of range, like the static version
+    argc = get_or_add_global(module, ARGC, i32, ir.Constant(i32, 0))
+    table = get_or_add_global(module, table_name, elem_type.as_pointer(), ir.Constant(elem_type.as_pointer(), None))
+    func = new_arg_function(module, name, elem_type)
+    builder = ir.IRBuilder(func.append_basic_block("entry"))
+    generate_table_load(func, builder, builder.load(argc), builder.load(table))
 
 def generate_extern(ast, module, undefined_args):
-    if ast["globid"] == "arg":
-        generate_arg(ast, module, undefined_args)
-    elif ast["globid"] == "argf":
-        generate_argf(ast, module, undefined_args)
+    if ast.globid == "arg":
+        if undefined_args is None:
+            generate_runtime_arg(module, "arg", ARGV_INT, i32)
+        else:
+            generate_static_arg(module, "arg", i32, [int_arg(arg) for arg in undefined_args])
+    elif ast.globid == "argf":
+        if undefined_args is None:
+            generate_runtime_arg(module, "argf", ARGV_FLOAT, f32)
+        else:
+            generate_static_arg(module, "argf", f32, [float_arg(arg) for arg in undefined_args])
     else:  
         args = []
-        ret_type = generate_type(ast["ret_type"])
-        if "tdecls" in ast:
-            for typ in ast["tdecls"]["types"]:
+        ret_type = generate_type(ast.ret_type)
+        if ast.tdecls is not None:
+            for typ in ast.tdecls:
                 args.append(generate_type(typ))
 
         fnty = ir.FunctionType(ret_type, args)
-        func = ir.Function(module, fnty, name=ast["globid"])
-
-def generate_externs(ast, module, undefined_args):
-    if "externs" in ast:
-        for extern in ast["externs"]:
-            generate_extern(extern, module, undefined_args)
-
-def generate_binop(ast, module, builder, variables):
-    op = ast["op"]
-    exptype = ast["exptype"]
-
-    lhs = generate_exp(ast["lhs"], module, builder, variables)
-    rhs = generate_exp(ast["rhs"], module, builder, variables)
-    # load if it is a pointer
-    # if lhs.type.is_pointer:
-    #     lhs = builder.load(lhs)
-    # if rhs.type.is_pointer:
-    #     rhs = builder.load(rhs)
-    lhs = load_var(builder, lhs)
-    rhs = load_var(builder, rhs)
-
-    if exptype == "bool":
-        if op == "and":
-            return builder.and_(lhs, rhs)
-        elif op == "or":
-            return builder.or_(lhs, rhs)
-        else:
-            if "int" in ast["lhs"]["exptype"]: 
-                if op == "lt":
-                    return builder.icmp_signed("<", lhs, rhs)
-                elif op == "gt":
-                    return builder.icmp_signed(">", lhs, rhs)
-                elif op == "eq":
-                    return builder.icmp_signed("==", lhs, rhs)
-            elif "float" in ast["lhs"]["exptype"]:
-                if op == "lt":
-                    return builder.fcmp_ordered("<", lhs, rhs)
-                elif op == "gt":
-                    return builder.fcmp_ordered(">", lhs, rhs)
-                elif op == "eq":
-                    return builder.fcmp_ordered("==", lhs, rhs)
-    elif "int" in exptype:
-        if op == "add":
-            return builder.add(lhs, rhs)
-        elif op == "sub":
-            return builder.sub(lhs, rhs)
-        elif op == "mul":
-            return builder.mul(lhs, rhs)
-        elif op == "div":
-            return builder.udiv(lhs, rhs)
-    elif "float" in exptype:
-        if op == "add":
-            return builder.fadd(lhs, rhs)
-        elif op == "sub":
-            return builder.fsub(lhs, rhs)
-        elif op == "mul":
-            return builder.fmul(lhs, rhs)
-        elif op == "div":
-            return builder.fdiv(lhs, rhs)
-    elif exptype == "void":
-        pass
-
-def generate_uop(ast, module, builder, variables):
-    op = ast["op"]
-    exptype = ast["exptype"]
-    if op == "not":
-        return builder.not_(generate_exp(ast["exp"], module, builder, variables))
-    elif op == "minus":
-        exp = generate_exp(ast["exp"], module, builder, variables)
-        # if exp.type.is_pointer:
-        #     exp = builder.load(exp)
-        exp = load_var(builder, exp)
-        if ast["exptype"] == "float":
-            return builder.fsub(ir.Constant(generate_type("float"), 0.0), exp)
-        elif ast["exptype"] == "int":
-            return builder.sub(ir.Constant(generate_type("int"), 0), exp)
-
-def is_int(typ):
-    return "int" in typ
-
-def is_float(typ):
-    return "float" in typ
-
-def generate_caststmt(ast, module, builder, variables):
-    typ = generate_type(ast["type"])
-    exp = generate_exp(ast["exp"], module, builder, variables)
-    # if exp.type.is_pointer:
-    #     exp = builder.load(exp)
-    exp = load_var(builder, exp)
-    if is_int(ast["type"]) and is_int(ast["exp"]["exptype"]):
-        exp = builder.trunc(exp, ir.IntType(32))
-    elif is_int(ast["type"]) and is_float(ast["exp"]["exptype"]):
-        exp = builder.fptoui(exp, ir.IntType(32))
-    elif is_float(ast["type"])and is_float(ast["exp"]["exptype"]):
-        exp = builder.fptrunc(exp, ir.FloatType())
-    elif is_float(ast["type"]) and is_int(ast["exp"]["exptype"]):
-        exp = builder.uitofp(exp, ir.FloatType())
-    return exp
-
-def generate_assign(ast, module, builder, variables):
-    exp = generate_exp(ast["exp"], module, builder, variables)
-    # if exp.type.is_pointer:
-    #     exp = builder.load(exp)
-    exp = load_var(builder, exp)
-    builder.store(exp, variables[ast["var"]])
-
-def generate_funccall(ast, module, builder, variables):
-    fn = module.get_global(ast["globid"])
-    args = []
-    if "params" not in ast or "exps" not in ast["params"]:
-        pass
-    else:
-        for exp in ast["params"]["exps"]:
-            args.append(generate_exp(exp, module, builder, variables))
-        
-        # Customize arg to the desired type
-        for idx, arg, fn_arg in zip(list(range(len(args))), args, fn.args):
-            arg = get_pointer(builder, arg)
-            if type(arg.type) == type(fn_arg.type):
-                args[idx] = arg
+        func = ir.Function(module, fnty, name=ast.globid)
+
+def generate_externs(externs, module, undefined_args):
+    for extern in externs:
+        generate_extern(extern, module, undefined_args)
+
+class CodeGenerator(visitor.Visitor):
+    """
+    Generates the functions of a module.  Statements and expressions are
+    generated by an iterative walk (see visitor.walk): every handler is a
+    generator that yields its child nodes and gets their values back, so
+    deeply nested code does not recurse in Python.  Expression handlers
+    return their llvmlite value; builder, func and variables describe the
+    function being generated.
+    """
+    handlers = {
+        astnodes.Blk: "generate_blk",
+        astnodes.If: "generate_if",
+        astnodes.Ret: "generate_ret",
+        astnodes.VarDeclStmt: "generate_vardeclstmt",
+        astnodes.ExpStmt: "generate_expstmt",
+        astnodes.While: "generate_while",
+        astnodes.Print: "generate_print",
+        astnodes.PrintSlit: "generate_printslit",
+        astnodes.Binop: "generate_binop",
+        astnodes.CastStmt: "generate_caststmt",
+        astnodes.Uop: "generate_uop",
+        astnodes.Lit: "generate_lit",
+        astnodes.VarVal: "generate_varval",
+        astnodes.Assign: "generate_assign",
+        astnodes.FuncCall: "generate_funccall",
+    }
+
+    def __init__(self, module):
+        visitor.Visitor.__init__(self)
+        self.module = module
+        self.builder = None
+        self.entry_builder = None
+        self.func = None
+        self.variables = None
+        self.overflow_block = None
+        # the string literals of the module, key: string, value: its global
+        self.strings = {}
+
+    def generate_func(self, ast):
+        module = self.module
+        args_types = [] # the types of args in llvmlite
+        args_names = [] # the names of args in llvmlite
+        ret_type = generate_type(ast.ret_type)
+        if ast.vdecls is not None:
+            for vdecl in ast.vdecls:
+                args_types.append(generate_type(vdecl.type))
+                args_names.append(vdecl.var)
+
+        # Adds function to module
+        fnty = ir.FunctionType(ret_type, args_types)
+        func = ir.Function(module, fnty, name=ast.globid)
+
+        # add_attribute("noalias")
+        if ast.vdecls is not None:
+            for idx, vdecl in enumerate(ast.vdecls):
+                if vdecl.type.noalias:
+                    func.args[idx].add_attribute("noalias")
+
+        # Adds entry block to the function; it only holds the local
+        # slots (see entry_alloca) and jumps to the code
+        entry_block = func.append_basic_block(name="entry")
+        body_block = func.append_basic_block(name="body")
+        builder = ir.IRBuilder(body_block)
+        self.builder = builder
+        self.entry_builder = ir.IRBuilder(entry_block)
+        self.func = func
+        # the local variables in scope, key: variable name, value: its pointer
+        self.variables = ChainMap()
+        self.overflow_block = None
+
+        # Allocates function arguments
+        for arg, name in zip(func.args, args_names):
+            if arg.type.is_pointer:
+                self.variables[name] = arg
             else:
-                if fn_arg.type.is_pointer:
-                    if arg.type.is_pointer:
-                        args[idx] = arg
-                    else:
-                        args[idx] = arg.as_pointer
-                else:
-                    if arg.type.is_pointer:
-                        args[idx] = builder.load(arg)
-                    else:
-                        args[idx] = arg
-    return builder.call(fn, args)
-
-def generate_exp(ast, module, builder, variables):
-    name = ast["name"]
-    if name == "binop":
-        return generate_binop(ast, module, builder, variables)
-    elif name == "caststmt":
-        return generate_caststmt(ast, module, builder, variables)
-    elif name == "uop":
-        return generate_uop(ast, module, builder, variables)
-    elif name == "lit":
-        return ir.Constant(generate_type(ast["exptype"]), ast["value"])
-    elif name == "varval":
-        return variables[ast["var"]] 
-    elif name == "assign":
-        return generate_assign(ast, module, builder, variables)
-    elif name == "funccall":
-        return generate_funccall(ast, module, builder, variables)
-
-def generate_stmt(ast, module, builder, func, variables):
-    name = ast["name"]
-    if name == "blk":
-        generate_blk(ast, module, builder, func, variables)
-    elif name == "if":
-        pred = generate_exp(ast["cond"], module, builder, variables)
-        if "else_stmt" in ast:
-            with builder.if_else(pred) as (then, otherwise):
-                with then:
-                    generate_stmt(ast["stmt"], module, builder, func, variables)
-                with otherwise:
-                    generate_stmt(ast["else_stmt"], module, builder, func, variables)
-        else:
-            with builder.if_then(pred):
-                generate_stmt(ast["stmt"], module, builder, func, variables)
-    elif name == "ret":
-        if "exp" in ast:
-            exp = generate_exp(ast["exp"], module, builder, variables)
-            # if exp.type.is_pointer:
-            #     exp = builder.load(exp)
-            exp = load_var(builder, exp)
-            builder.ret(exp)
+                ptr = self.entry_alloca(arg.type)
+                self.variables[name]= ptr
+                builder.store(arg, ptr)
+
+        self.walk(ast.blk)
+        self.entry_builder.branch(body_block)
+
+        # Returns void if return type is void; the end of other functions
+        # is only reachable through a missing return
+        if not builder.block.is_terminated:
+            if ast.ret_type is ektypes.VOID:
+                builder.ret_void()
+            else:
+                builder.unreachable()
+
+    def entry_alloca(self, typ):
+        # every local slot is allocated in the entry block, so
+        # declarations in loops do not grow the stack and mem2reg can
+        # promote them; the stores stay where the declarations are
+        return self.entry_builder.alloca(typ)
+
+    # Statements
+
+    def generate_blk(self, ast):
+        # variables declared in the block go out of scope at its end
+        outer = self.variables
+        self.variables = outer.new_child()
+        if ast.stmts is not None:
+            for stmt in ast.stmts:
+                # code after a return is unreachable but must still
+                # go into a block of its own
+                if self.builder.block.is_terminated:
+                    self.builder.position_at_end(self.func.append_basic_block("dead"))
+                yield stmt
+        self.variables = outer
+
+    def generate_if(self, ast):
+        builder = self.builder
+        pred = load_var(builder, (yield ast.cond))
+        then_block = self.func.append_basic_block("if.then")
+        if ast.else_stmt is not None:
+            else_block = self.func.append_basic_block("if.else")
+        end_block = self.func.append_basic_block("if.end")
+        builder.cbranch(pred, then_block, else_block if ast.else_stmt is not None else end_block)
+        builder.position_at_end(then_block)
+        yield ast.stmt
+        if not builder.block.is_terminated:
+            builder.branch(end_block)
+        if ast.else_stmt is not None:
+            builder.position_at_end(else_block)
+            yield ast.else_stmt
+            if not builder.block.is_terminated:
+                builder.branch(end_block)
+        builder.position_at_end(end_block)
+
+    def generate_ret(self, ast):
+        if ast.exp is not None:
+            exp = yield ast.exp
+            exp = load_var(self.builder, exp)
+            self.builder.ret(exp)
         else:
-            builder.ret_void()
-    elif name == "vardeclstmt": 
-        exp = generate_exp(ast["exp"], module, builder, variables)
-        variables[ast["vdecl"]["var"]] = builder.alloca(exp.type)
-        if "noalias" in ast["vdecl"]["type"]:
-            variables[ast["vdecl"]["var"]].add_attribute("noalias")
-        if "ref" not in ast["vdecl"]["type"]:
-            exp = load_var(builder, exp)
-        builder.store(exp, variables[ast["vdecl"]["var"]])
-    elif name == "expstmt":
-        generate_exp(ast["exp"], module, builder, variables)
-    elif name == "while":
+            self.builder.ret_void()
+
+    def generate_vardeclstmt(self, ast):
+        builder = self.builder
+        variables = self.variables
+        exp = yield ast.exp
+        if ast.vdecl.type.is_ref:
+            # a ref names the variable it is initialized with, as ref
+            # arguments do; noalias only applies to arguments
+            variables[ast.vdecl.var] = exp
+            return
+        variables[ast.vdecl.var] = self.entry_alloca(ast.vdecl.type.ir_type)
+        builder.store(load_var(builder, exp), variables[ast.vdecl.var])
+
+    def generate_expstmt(self, ast):
+        yield ast.exp
+
+    def generate_while(self, ast):
+        builder = self.builder
+        func = self.func
         loop_head = func.append_basic_block("loop.header")
         loop_body = func.append_basic_block("loop.body")
         loop_end = func.append_basic_block("loop.end")
         builder.branch(loop_head)
         builder.position_at_end(loop_head)
-        cond = generate_exp(ast["cond"], module, builder, variables)
+        cond = load_var(builder, (yield ast.cond))
         builder.cbranch(cond, loop_body, loop_end)
         builder.position_at_end(loop_body)
         #loop body
-        generate_stmt(ast["stmt"], module, builder, func, variables)
+        yield ast.stmt
         #jump to loop head
-        builder.branch(loop_head)
+        if not builder.block.is_terminated:
+            builder.branch(loop_head)
         builder.position_at_end(loop_end)
-    elif name == "print":
-        value = generate_exp(ast["exp"], module, builder, variables)
-        if value.type.is_pointer:
-            value = load_var(builder, value)
-            if value.type == ir.FloatType():
-                global_fmt = module.get_global("fstr_float")
-                value = builder.fpext(value, ir.DoubleType(), name='float_double')
-            elif value.type == ir.IntType(32):
-                global_fmt = module.get_global("fstr_int")
-            elif value.type == ir.IntType(1):
-                global_fmt = module.get_global("fstr_int")
-                value = builder.zext(value, ir.IntType(32), name='bool_int')
-        elif value.type == ir.IntType(32):
-            global_fmt = module.get_global("fstr_int")
-        elif value.type == ir.IntType(1):
-            global_fmt = module.get_global("fstr_int")
-            value = builder.zext(value, ir.IntType(32), name='bool_int')
+
+    def generate_print(self, ast):
+        module = self.module
+        builder = self.builder
+        value = load_var(builder, (yield ast.exp))
+        if value.type == f32:
+            print_func = module.get_global(runtime.PRINT_FLOAT)
+            value = builder.fpext(value, f64, name='float_double')
+        elif value.type == i1:
+            print_func = module.get_global(runtime.PRINT_INT)
+            value = builder.zext(value, i32, name='bool_int')
         else:
-            global_fmt = module.get_global("fstr_float")
-            value = builder.fpext(value, ir.DoubleType(), name='float_double')
-        printf_func = module.get_global("printf")
-        voidptr_ty = ir.IntType(8).as_pointer()
-        fmt_arg = builder.bitcast(global_fmt, voidptr_ty)
-        #call printf function
-        builder.call(printf_func, [fmt_arg, value])
-    elif name == "printslit":
-        # construct c_str
-        c_str_val = generate_slit(ast["string"]+"\0")
-        c_str = builder.alloca(c_str_val.type)
-        builder.store(c_str_val, c_str)
-        printf_func = module.get_global("printf")
-        global_fmt = module.get_global("fstr_slit")
-        voidptr_ty = ir.IntType(8).as_pointer()
-        fmt_arg = builder.bitcast(global_fmt, voidptr_ty)
-        # Call print Function
-        builder.call(printf_func, [fmt_arg, c_str])
-
-def generate_blk(ast, module, builder, func, variables):
-    if "contents" in ast:
-        for stmt in ast["contents"]["stmts"]:
-            generate_stmt(stmt, module, builder, func, variables)
-
-def generate_func(ast, module):
-    args_types = [] # the types of args in llvmlite
-    args_names = [] # the names of args in llvmlite
-    variables = {}  # the local vairables in the current function, key: variable name, value: variable type
-    ret_type = generate_type(ast["ret_type"])
-    if "vdecls" in ast:
-        for vdecl in ast["vdecls"]["vars"]:
-            args_types.append(generate_type(vdecl["type"]))
-            args_names.append(vdecl["var"])
-
-    # Adds function to module
-    fnty = ir.FunctionType(ret_type, args_types)
-    func = ir.Function(module, fnty, name=ast["globid"])
-
-    # add_attribute("noalias")
-    if "vdecls" in ast:
-        for idx, vdecl in enumerate(ast["vdecls"]["vars"]):
-            if "noalias" in vdecl:
-                func.args[idx].add_attribute("noalias")
-    
-    # Adds entry block to the function
-    entry_block = func.append_basic_block(name="entry")
-    builder = ir.IRBuilder(entry_block)
-
-    # Allocates function arguments
-    for arg, name in zip(func.args, args_names):
-        if arg.type.is_pointer:
-            variables[name] = arg
+            print_func = module.get_global(runtime.PRINT_INT)
+        builder.call(print_func, [value])
+
+    def generate_printslit(self, ast):
+        c_str = self.string_constant(ast.string)
+        size = ir.Constant(ir.IntType(64), len(ast.string.encode("utf8")))
+        self.builder.call(self.module.get_global(runtime.PRINT_STR), [c_str, size])
+
+    def string_constant(self, string):
+        # every distinct string literal is one internal constant of the
+        # module; returns a pointer to its first character
+        c_str = self.strings.get(string)
+        if c_str is None:
+            c_str_val = generate_slit(string + "\0")
+            global_str = ir.GlobalVariable(self.module, c_str_val.type, name=self.module.get_unique_name("slit"))
+            global_str.linkage = "internal"
+            global_str.global_constant = True
+            global_str.unnamed_addr = True
+            global_str.initializer = c_str_val
+            zero = ir.Constant(i32, 0)
+            c_str = self.strings[string] = global_str.gep([zero, zero])
+        return c_str
+
+    # Expressions
+
+    def generate_binop(self, ast):
+        if ast.op == "and" or ast.op == "or":
+            return (yield from self.generate_short_circuit(ast))
+        builder = self.builder
+        op = ast.op
+        exptype = ast.exptype
+
+        lhs = yield ast.lhs
+        rhs = yield ast.rhs
+        # load if it is a pointer
+        lhs = load_var(builder, lhs)
+        rhs = load_var(builder, rhs)
+
+        if exptype is ektypes.BOOL:
+            if ast.lhs.exptype.is_float:
+                if op == "lt":
+                    return builder.fcmp_ordered("<", lhs, rhs)
+                elif op == "gt":
+                    return builder.fcmp_ordered(">", lhs, rhs)
+                elif op == "eq":
+                    return builder.fcmp_ordered("==", lhs, rhs)
+            else:
+                if op == "lt":
+                    return builder.icmp_signed("<", lhs, rhs)
+                elif op == "gt":
+                    return builder.icmp_signed(">", lhs, rhs)
+                elif op == "eq":
+                    return builder.icmp_signed("==", lhs, rhs)
+        elif exptype.checked:
+            return self.generate_checked(op, lhs, rhs)
+        elif exptype.is_int:
+            if op == "add":
+                return builder.add(lhs, rhs)
+            elif op == "sub":
+                return builder.sub(lhs, rhs)
+            elif op == "mul":
+                return builder.mul(lhs, rhs)
+            elif op == "div":
+                return builder.udiv(lhs, rhs)
+        elif exptype.is_float:
+            if op == "add":
+                return builder.fadd(lhs, rhs)
+            elif op == "sub":
+                return builder.fsub(lhs, rhs)
+            elif op == "mul":
+                return builder.fmul(lhs, rhs)
+            elif op == "div":
+                return builder.fdiv(lhs, rhs)
+
+    def generate_short_circuit(self, ast):
+        # rhs is only evaluated when lhs does not decide the result; the
+        # optimizer turns the branch back into a select when rhs is cheap
+        builder = self.builder
+        lhs = to_bool(builder, load_var(builder, (yield ast.lhs)))
+        lhs_block = builder.block
+        rhs_block = self.func.append_basic_block(ast.op + ".rhs")
+        end_block = self.func.append_basic_block(ast.op + ".end")
+        if ast.op == "and":
+            builder.cbranch(lhs, rhs_block, end_block)
         else:
-            ptr = builder.alloca(arg.type)
-            variables[name]= ptr
-            builder.store(arg, ptr)
-    
-    if "blk" in ast:
-        result = generate_blk(ast["blk"], module, builder, func, variables)
-
-    # Returns void if return type is void
-    if ast["ret_type"] == "void":
-        builder.ret_void()
-    
-def generate_funcs(ast, module):
-    for func in ast["funcs"]:
-        generate_func(func, module)
+            builder.cbranch(lhs, end_block, rhs_block)
+        builder.position_at_end(rhs_block)
+        rhs = to_bool(builder, load_var(builder, (yield ast.rhs)))
+        # rhs may have ended in another block of its own
+        rhs_block = builder.block
+        builder.branch(end_block)
+        builder.position_at_end(end_block)
+        result = builder.phi(i1)
+        result.add_incoming(ir.Constant(i1, ast.op == "or"), lhs_block)
+        result.add_incoming(rhs, rhs_block)
+        return result
+
+    def generate_uop(self, ast):
+        builder = self.builder
+        op = ast.op
+        exp = yield ast.exp
+        exp = load_var(builder, exp)
+        if op == "not":
+            return builder.not_(exp)
+        elif op == "minus":
+            if ast.exptype.is_float:
+                return builder.fsub(ir.Constant(f32, 0.0), exp)
+            elif ast.exptype.checked:
+                return self.generate_checked("sub", ir.Constant(i32, 0), exp)
+            elif ast.exptype.is_int:
+                return builder.sub(ir.Constant(i32, 0), exp)
+
+    # cint arithmetic
+
+    def get_overflow_block(self):
+        # every check of a function branches to the same cold block
+        if self.overflow_block is None:
+            self.overflow_block = self.func.append_basic_block("cint.overflow")
+            with self.builder.goto_block(self.overflow_block):
+                self.builder.call(self.module.get_global(runtime.OVERFLOW), [])
+                self.builder.unreachable()
+        return self.overflow_block
+
+    def check_overflow(self, failed):
+        ok_block = self.func.append_basic_block("cint.ok")
+        branch = self.builder.cbranch(failed, self.get_overflow_block(), ok_block)
+        branch.set_weights([1, OVERFLOW_WEIGHT])
+        self.builder.position_at_end(ok_block)
+
+    def generate_checked(self, op, lhs, rhs):
+        builder = self.builder
+        if op == "div":
+            # division overflows only for INT_MIN / -1
+            zero = builder.icmp_signed("==", rhs, ir.Constant(i32, 0))
+            min_lhs = builder.icmp_signed("==", lhs, ir.Constant(i32, -2**31))
+            minus_one = builder.icmp_signed("==", rhs, ir.Constant(i32, -1))
+            self.check_overflow(builder.or_(zero, builder.and_(min_lhs, minus_one)))
+            return builder.sdiv(lhs, rhs)
+        if op == "add":
+            result = builder.sadd_with_overflow(lhs, rhs)
+        elif op == "sub":
+            result = builder.ssub_with_overflow(lhs, rhs)
+        elif op == "mul":
+            result = builder.smul_with_overflow(lhs, rhs)
+        self.check_overflow(builder.extract_value(result, 1))
+        return builder.extract_value(result, 0)
+
+    def generate_caststmt(self, ast):
+        builder = self.builder
+        exp = yield ast.exp
+        exp = load_var(builder, exp)
+        if ast.type.is_int and ast.exp.exptype.is_int:
+            pass # int and cint are both i32
+        elif ast.type.is_int and ast.exp.exptype.is_float:
+            exp = builder.fptoui(exp, i32)
+        elif ast.type.is_float and ast.exp.exptype.is_float:
+            pass
+        elif ast.type.is_float and ast.exp.exptype.is_int:
+            exp = builder.uitofp(exp, f32)
+        return exp
+
+    def generate_lit(self, ast):
+        return ir.Constant(ast.exptype.ir_type, ast.value)
+
+    def generate_varval(self, ast):
+        return self.variables[ast.var]
+
+    def generate_assign(self, ast):
+        exp = yield ast.exp
+        exp = load_var(self.builder, exp)
+        self.builder.store(exp, self.variables[ast.var])
+
+    def generate_funccall(self, ast):
+        builder = self.builder
+        fn = self.module.get_global(ast.globid)
+        args = []
+        if ast.params is not None:
+            for exp in ast.params:
+                args.append((yield exp))
+
+            # Customize arg to the desired type
+            for idx, arg, fn_arg in zip(list(range(len(args))), args, fn.args):
+                arg = get_pointer(builder, arg)
+                if type(arg.type) == type(fn_arg.type):
+                    args[idx] = arg
+                else:
+                    if fn_arg.type.is_pointer:
+                        if arg.type.is_pointer:
+                            args[idx] = arg
+                        else:
+                            args[idx] = arg.as_pointer
+                    else:
+                        if arg.type.is_pointer:
+                            args[idx] = builder.load(arg)
+                        else:
+                            args[idx] = arg
+        return builder.call(fn, args)
+
+def generate_funcs(funcs, module):
+    generator = CodeGenerator(module)
+    for func in funcs:
+        generator.generate_func(func)
 
 def generate_prog(ast, module, undefined_args):
-    if "externs" in ast and len(ast) > 1:
-        generate_externs(ast["externs"], module, undefined_args)
-
-    generate_funcs(ast["funcs"], module)
-
-def declare_printf(module):
-    #declare printf
-    voidptr_ty = ir.IntType(8).as_pointer()
-    printf_ty = ir.FunctionType(ir.IntType(32), [voidptr_ty], var_arg=True)
-    printf = ir.Function(module, printf_ty, name="printf")
-    #int type
-    fmt1 = "%d\n\0"
-    c_fmt1 = ir.Constant(ir.ArrayType(ir.IntType(8), len(fmt1)), bytearray(fmt1.encode("utf8")))
-    global_fmt1 = ir.GlobalVariable(module, c_fmt1.type, name="fstr_int")
-    global_fmt1.linkage = 'internal'
-    global_fmt1.global_constant = True
-    global_fmt1.initializer = c_fmt1
-    #slit type
-    fmt2 = "%s\n\0"
-    c_fmt2 = ir.Constant(ir.ArrayType(ir.IntType(8), len(fmt2)), bytearray(fmt2.encode("utf8")))
-    global_fmt2 = ir.GlobalVariable(module, c_fmt2.type, name="fstr_slit")
-    global_fmt2.linkage = 'internal'
-    global_fmt2.global_constant = True
-    global_fmt2.initializer = c_fmt2
-    #float type
-    fmt3 = "%f\n\0"
-    c_fmt3 = ir.Constant(ir.ArrayType(ir.IntType(8), len(fmt3)), bytearray(fmt3.encode("utf8")))
-    global_fmt3 = ir.GlobalVariable(module, c_fmt3.type, name="fstr_float")
-    global_fmt3.linkage = 'internal'
-    global_fmt3.global_constant = True
-    global_fmt3.initializer = c_fmt3
-
-# The function called by ekcc.py
-def generate_code(ast, undefined_args):
-    module = ir.Module(name="prog")
-    declare_printf(module)
-    generate_prog(ast, module, undefined_args)
+    generate_externs(ast.externs, module, undefined_args)
+    generate_funcs(ast.funcs, module)
+
+def generate_function_module(ast, callees):
+    """
+    A module holding only the function ast, for incremental builds.
+    The functions it calls, given as (name, ret_type, arg types) in
+    callees, and the output runtime are declared, to be resolved when
+    the module is linked with the rest of the program.
+    """
+    module = ir.Module(name=ast.globid)
+    runtime.declare_runtime(module)
+    for name, ret_type, arg_types in callees:
+        if name != ast.globid:
+            fnty = ir.FunctionType(generate_type(ret_type), [generate_type(typ) for typ in arg_types])
+            ir.Function(module, fnty, name=name)
+    CodeGenerator(module).generate_func(ast)
     return module
 
+# cint overflow: the checks branch to runtime.OVERFLOW with this weight
+# against 1, so the overflow path is laid out as cold code
+OVERFLOW_WEIGHT = 1 << 20
+
+# The function called by ekcc.py.  arg/argf return the given
+# undefined_args baked into the module, or, when undefined_args is None,
+# read the arguments the host passes to each run of the program.  With
+# aot the module is for an object file or executable, not the JIT.
+def generate_code(ast, undefined_args, aot=False):
+    with timing.phase("generate_code"):
+        module = ir.Module(name="prog")
+        runtime.define_runtime(module, aot)
+        generate_prog(ast, module, undefined_args)
+        if not aot:
+            runtime.define_run_guarded(module)
+        return module
+
@@ -0,0 +1,135 @@
+import argparse, os, sys, traceback
+from concurrent.futures import ProcessPoolExecutor
+import astformat
+
+# Output suffix of each output kind, appended to the input name; ASTs
+# get .ast.<format>
+OUTPUT_SUFFIXES = [("emit_ast", ".ast."), ("emit_llvm", ".ll"), ("c", ".o"), ("S", ".s"), ("exe", "")]
+
+parser = argparse.ArgumentParser(prog=sys.argv[0],
+                                 description='Compile many ek files in parallel',
+                                 usage="python3 driver.py [-h] [-O|-O0|-O1|-O2|-O3] [-static-args] [-j <jobs>] -emit-ast[=yaml|json|bin]|-emit-llvm|-c|-S|-exe [-o <output-dir>] <input-file-or-dir>... [-- <args>...]",
+                                 add_help=False)
+parser.add_argument("-h", action="help", help="show this help message and exit")
+parser.add_argument("-O", dest="opt_level", action="store_const", const=2, default=0, help="enable optimization (same as -O2)")
+for level in range(4):
+    parser.add_argument("-O%d" % level, dest="opt_level", action="store_const", const=level, help="set optimization level to %d" % level)
+parser.add_argument("-static-args", action="store_true", default=False, help="compile the arguments after -- into every program")
+parser.add_argument("-emit-ast", dest="emit_ast", action="store_const", const="yaml", default=None, help="generate AST (<name>.ast.yaml)")
+for fmt in astformat.FORMATS:
+    parser.add_argument("-emit-ast=" + fmt, dest="emit_ast", action="store_const", const=fmt, help="generate AST as %s (<name>.ast.%s)" % (fmt.upper(), fmt))
+parser.add_argument("-emit-llvm", action="store_true", default=False, help="generate optimized LLVM IR (<name>.ll)")
+parser.add_argument("-c", action="store_true", default=False, help="compile to native object files (<name>.o)")
+parser.add_argument("-S", action="store_true", default=False, help="compile to native assembly (<name>.s)")
+parser.add_argument("-exe", action="store_true", default=False, help="compile and link native executables (<name>)")
+parser.add_argument("-j", type=int, default=None, metavar="jobs", help="number of worker processes (default: one per CPU)")
+parser.add_argument("-o", default=None, metavar="output-dir", help="directory for the outputs (default: next to each input)")
+parser.add_argument("inputs", nargs="+", help="ek files, or directories searched for *.ek files")
+
+def find_inputs(inputs):
+    """
+    The .ek files named by inputs, directories expanded recursively, in
+    a deterministic order.
+    """
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".ek"))
+        else:
+            files.append(path)
+    return files
+
+def output_paths(files, output_dir, suffix):
+    """
+    Map every input to its output: the input path with its extension
+    replaced by suffix, next to the input or, with output_dir, at the
+    same place relative to the inputs' common directory under it.
+    """
+    if output_dir is None:
+        return [os.path.splitext(path)[0] + suffix for path in files]
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in files])
+    return [os.path.join(output_dir, os.path.splitext(os.path.relpath(os.path.abspath(path), base))[0] + suffix)
+            for path in files]
+
+def init_worker():
+    # Build the parser and the LLVM target once per worker
+    import yacc, binding
+    yacc.get_parser()
+    binding.get_target_machine(aot=True)
+
+def compile_one(path, output_file, options):
+    """
+    Compile one file; returns None on success or the error message.
+    """
+    import ekcc, yacc, codeGen, binding
+    try:
+        ast, err_message = yacc.parse(ekcc.read_content(path))
+        if err_message != None:
+            return err_message
+        directory = os.path.dirname(output_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if options.emit_ast:
+            ekcc.write_ast(output_file, ast, options.emit_ast)
+            return None
+        mod = codeGen.generate_code(ast, options.args if options.static_args else None, aot=True)
+        if options.emit_llvm:
+            ekcc.write_to_file(output_file, binding.optimize_ir(mod, options.opt_level))
+        elif options.c:
+            ekcc.write_binary(output_file, binding.emit_object(mod, options.opt_level))
+        elif options.S:
+            ekcc.write_to_file(output_file, binding.emit_assembly(mod, options.opt_level))
+        else:
+            binding.link_executable(mod, output_file, options.opt_level)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+# The function called by main()
+def compile_all(files, options):
+    """
+    Compile files concurrently on options.j worker processes and return
+    a list of (input, output, error message or None) in input order.
+    """
+    suffix = [suffix for name, suffix in OUTPUT_SUFFIXES if getattr(options, name)][0]
+    if options.emit_ast:
+        suffix += options.emit_ast
+    outputs = output_paths(files, options.o, suffix)
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("several inputs would be written to the same output; use -o <output-dir>")
+    jobs = min(options.j or os.cpu_count() or 1, max(len(files), 1))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+        errors = pool.map(compile_one, files, outputs, [options] * len(files))
+        return list(zip(files, outputs, errors))
+
+def main(argv):
+    if "--" in argv:
+        program_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    else:
+        program_args = []
+    options = parser.parse_args(argv)
+    options.args = program_args
+    if sum(bool(getattr(options, name)) for name, _ in OUTPUT_SUFFIXES) != 1:
+        parser.error("exactly one of -emit-ast, -emit-llvm, -c, -S and -exe is required")
+    files = find_inputs(options.inputs)
+    if not files:
+        parser.error("no .ek files found")
+    try:
+        results = compile_all(files, options)
+    except ValueError as e:
+        parser.error(str(e))
+    failed = 0
+    for path, output_file, error in results:
+        if error is None:
+            print(path + " -> " + output_file)
+        else:
+            failed += 1
+            print(path + ": " + error.rstrip(), file=sys.stderr)
+    print("%d compiled, %d failed" % (len(files) - failed, failed))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,5 @@
-import argparse, sys
-import lexer, yacc, codeGen, binding
-import yaml
+import argparse, os, sys
+import lexer, yacc, codeGen, binding, incremental, stream, astformat, server, batch, timing
 
 def read_content(input_file):
     with open(input_file, 'r') as input:  
@@ -14,35 +13,168 @@ def write_to_file(output_file, content):
     else:
         output_file.write(content)
 
+def write_binary(output_file, content):
+    with open(output_file, 'wb') as output:
+        output.write(content)
+
+def write_ast(output_file, ast, fmt):
+    binary = fmt == "bin"
+    if isinstance(output_file, str):
+        with open(output_file, 'wb' if binary else 'w') as output:
+            astformat.dump(ast, fmt, output)
+    elif binary:
+        output_file.flush()
+        astformat.dump(ast, fmt, output_file.buffer)
+        output_file.buffer.flush()
+    else:
+        astformat.dump(ast, fmt, output_file)
+
+def output_path(args, suffix):
+    # Like cc, ahead-of-time outputs default to the input name with suffix
+    if isinstance(args.o, str):
+        return args.o
+    return os.path.splitext(os.path.basename(args.input_file))[0] + suffix
+
 parser = argparse.ArgumentParser(prog=sys.argv[0], 
                                  description='Compiler',
-                                 usage="python3 ekcc.py [-h|-?] [-v] [-O] [-emit-ast|-emit-llvm] -o <output-file> <input-file>", 
+                                 usage="python3 ekcc.py [-h|-?] [-v] [-time-report <file>] [-time-memory] [-O|-O0|-O1|-O2|-O3] [-static-args] [-incremental] [-stream] [-from-ast] [-emit-ast[=yaml|json|bin]|-emit-llvm|-c|-S|-exe] -o <output-file> <input-file> [<args>...]\n"
+                                       "       python3 ekcc.py [-O...] [-j <jobs>] -run-batch <inputs.csv> <input-file>\n"
+                                       "       python3 ekcc.py --serve [<socket>]",
                                  add_help=False)
 parser.add_argument("-h", action="help", help="show this help message and exit")
-parser.add_argument("-v", action="store_true", help="print information for debugging")
-parser.add_argument("-O", action="store_true", help="enable optimization")
-parser.add_argument("-emit-ast", action="store_true", default=False, help="generate AST")
+parser.add_argument("-v", action="store_true", help="print the time of every compiler phase to stderr")
+parser.add_argument("-time-report", metavar="file", help="write the time of every compiler phase to file as JSON")
+parser.add_argument("-time-memory", action="store_true", help="with -v or -time-report, also measure the Python heap growth of every phase (slows the Python phases)")
+parser.add_argument("-O", dest="opt_level", action="store_const", const=2, default=0, help="enable optimization (same as -O2)")
+for level in range(4):
+    parser.add_argument("-O%d" % level, dest="opt_level", action="store_const", const=level, help="set optimization level to %d" % level)
+parser.add_argument("-emit-ast", dest="emit_ast", action="store_const", const="yaml", default=None, help="generate AST")
+for fmt in astformat.FORMATS:
+    parser.add_argument("-emit-ast=" + fmt, dest="emit_ast", action="store_const", const=fmt, help="generate AST as %s" % fmt.upper())
 parser.add_argument("-emit-llvm", action="store_true", default=False, help="generate LLVM IR")
 parser.add_argument("-o", action="store", default=sys.stdout, help="set output file path")
-parser.add_argument("input_file", help = "ek file to be compiled")
-args, undefined = parser.parse_known_args()
+parser.add_argument("-static-args", action="store_true", default=False, help="compile the arguments for arg/argf into the program")
+parser.add_argument("-incremental", action="store_true", default=False, help="reuse the cached code of the functions unchanged since an earlier run")
+parser.add_argument("-stream", action="store_true", default=False, help="read, check and compile the input one extern or function at a time, for very large files")
+parser.add_argument("-from-ast", action="store_true", default=False, help="read the AST written by -emit-ast (in any format) instead of source")
+parser.add_argument("-c", action="store_true", default=False, help="compile to a native object file")
+parser.add_argument("-S", action="store_true", default=False, help="compile to native assembly")
+parser.add_argument("-exe", action="store_true", default=False, help="compile and link a native executable that takes the arguments of arg/argf on its command line")
+parser.add_argument("-run-batch", metavar="inputs.csv", help="run the program once per row of arguments in the CSV file")
+parser.add_argument("-j", type=int, default=None, metavar="jobs", help="number of worker processes (default: one per CPU)")
+parser.add_argument("--serve", nargs="?", const=server.DEFAULT_SOCKET, metavar="socket", help="run a compile server on a unix socket (default %s)" % server.DEFAULT_SOCKET)
+parser.add_argument("input_file", nargs="?", help = "ek file to be compiled")
 
-exitcode = 0
+def compile_file(args, undefined):
+    try:
+        return compile_input(args, undefined)
+    except codeGen.ArgumentError as e:
+        print(e.message)
+        print("exit code: "+str(1))
+        return 1
+    except binding.ProgramError as e:
+        # on stderr, like the error of an executable
+        sys.stderr.write(e.message + "\n")
+        print("exit code: "+str(1))
+        return 1
 
-if args.emit_ast and args.emit_llvm:
-    raise Exception("Cannot emit_ast and emit_llvm at the same time")
-else:
-    content = read_content(args.input_file)
-    ast, err_message = yacc.parse(content)
+def compile_input(args, undefined):
+    if args.emit_ast and args.emit_llvm:
+        raise Exception("Cannot emit_ast and emit_llvm at the same time")
+    if args.stream:
+        return stream_file(args, undefined)
+    if args.from_ast:
+        try:
+            with timing.phase("load_ast"):
+                ast = astformat.load(args.input_file)
+        except ValueError as e:
+            print("error: %s does not hold an AST (%s)" % (args.input_file, e))
+            print("exit code: "+str(1))
+            return 1
+        ast, err_message = yacc.check(ast)
+    else:
+        content = read_content(args.input_file)
+        ast, err_message = yacc.parse(content)
     if err_message != None:
         print(err_message)
         print("exit code: "+str(1))
-        sys.exit(1)
+        return 1
     if args.emit_ast:
-        write_to_file(args.o,  yaml.dump(ast))
-    mod = codeGen.generate_code(ast, undefined)
-    mod = binding.compile_and_execute(mod)
+        with timing.phase("emit_ast"):
+            write_ast(args.o, ast, args.emit_ast)
+    if args.c or args.S or args.exe:
+        mod = codeGen.generate_code(ast, undefined if args.static_args else None, aot=True)
+        if args.c:
+            write_binary(output_path(args, ".o"), binding.emit_object(mod, args.opt_level))
+        elif args.S:
+            write_to_file(output_path(args, ".s"), binding.emit_assembly(mod, args.opt_level))
+        else:
+            binding.link_executable(mod, output_path(args, ""), args.opt_level)
+        return 0
+    if args.run_batch:
+        mod = codeGen.generate_code(ast, None)
+        results = batch.run_batch(mod, batch.read_rows(args.run_batch), args.opt_level, args.j)
+        for exitcode, output in results:
+            sys.stdout.write(output)
+            print("exit code: "+str(exitcode))
+        return 0
+    if args.incremental:
+        if args.static_args:
+            mod = incremental.compile_and_execute(ast, undefined, args.opt_level)
+        else:
+            mod = incremental.compile_and_execute(ast, None, args.opt_level, undefined)
+    elif args.static_args:
+        mod = codeGen.generate_code(ast, undefined)
+        mod = binding.compile_and_execute(mod, args.opt_level)
+    else:
+        mod = codeGen.generate_code(ast, None)
+        mod = binding.compile_and_execute(mod, args.opt_level, undefined)
     if args.emit_llvm:
         write_to_file(args.o, mod)
+    print("exit code: "+str(0))
+    return 0
+
+def stream_file(args, undefined):
+    function_cache = incremental.get_function_cache() if args.incremental else None
+    try:
+        with open(args.input_file, 'r') as input:
+            if args.static_args:
+                mod = stream.compile_and_execute(input, undefined, args.opt_level, None, function_cache)
+            else:
+                mod = stream.compile_and_execute(input, None, args.opt_level, undefined, function_cache)
+    except yacc.CompilerException as e:
+        print(e.message)
+        print("exit code: "+str(1))
+        return 1
+    if args.emit_llvm:
+        write_to_file(args.o, mod)
+    print("exit code: "+str(0))
+    return 0
+
+# The entry point, also called by the compile server for every request
+def main(argv):
+    args, undefined = parser.parse_known_args(argv)
+    if args.serve:
+        return server.serve(args.serve)
+    if args.input_file is None:
+        parser.error("the following arguments are required: input_file")
+    if args.c + args.S + args.exe + args.emit_llvm + bool(args.run_batch) > 1:
+        parser.error("-c, -S, -exe, -emit-llvm and -run-batch are mutually exclusive")
+    if args.stream and (args.from_ast or args.emit_ast or args.c or args.S or args.exe or args.run_batch):
+        parser.error("-stream only applies to programs run in the JIT and cannot read or emit an AST")
+    if args.incremental and (args.c or args.S or args.exe or args.run_batch):
+        parser.error("-incremental only applies to programs run in the JIT")
+    if args.run_batch and (args.emit_llvm or args.static_args or undefined):
+        parser.error("-run-batch reads the program arguments from the CSV file and cannot be combined with -emit-llvm, -static-args or trailing arguments")
+    if args.v or args.time_report:
+        with timing.record(memory=args.time_memory) as recorder:
+            status = compile_file(args, undefined)
+        if args.v:
+            sys.stderr.write(recorder.report())
+        if args.time_report:
+            recorder.write_json(args.time_report)
+        return status
+    return compile_file(args, undefined)
 
-print("exit code: "+str(exitcode))
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
\ No newline at end of file
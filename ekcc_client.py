@@ -0,0 +1,7 @@
+import sys
+import server
+
+# Thin client for "ekcc.py --serve": takes the same flags as ekcc.py and
+# runs them in the server found at $EKCC_SOCKET.  "--shutdown" stops it.
+if __name__ == "__main__":
+    sys.exit(server.request(server.DEFAULT_SOCKET, sys.argv[1:]))
@@ -0,0 +1,101 @@
+from llvmlite import ir
+
+# The types of ek.  Every distinct type is a single interned Type
+# object, so types compare with `is`, hash by identity and carry their
+# llvmlite type; str() gives the source spelling used in the AST dumps
+# ('int', 'ref float', 'noalias ref int', ...).
+
+class Type():
+    """
+    kind is 'int', 'cint', 'float', 'bool' or 'void' for value types
+    and 'ref' for references, whose elem is the referenced type.  base
+    is the value type at the bottom of the references.
+    """
+    __slots__ = ("kind", "elem", "noalias", "base", "ir_type", "name")
+
+    def __init__(self, kind, elem=None, noalias=False):
+        self.kind = kind
+        self.elem = elem
+        self.noalias = noalias
+        if elem is None:
+            self.base = self
+            self.name = kind
+            self.ir_type = IR_TYPES[kind]
+        else:
+            self.base = elem.base
+            self.name = ("noalias ref " if noalias else "ref ") + elem.name
+            # ref void is parsed but rejected by the checker; it has no
+            # llvmlite type since LLVM has no pointers to void
+            if elem.kind == "void" or elem.ir_type is None:
+                self.ir_type = None
+            else:
+                self.ir_type = elem.ir_type.as_pointer()
+
+    @property
+    def is_ref(self):
+        return self.elem is not None
+
+    @property
+    def is_int(self):
+        # cint is an int whose arithmetic is checked for overflow
+        return self.base.kind in ("int", "cint")
+
+    @property
+    def is_float(self):
+        return self.base.kind == "float"
+
+    @property
+    def is_bool(self):
+        return self.base.kind == "bool"
+
+    @property
+    def checked(self):
+        return self.base.kind == "cint"
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "ektypes.parse(%r)" % self.name
+
+    def __reduce__(self):
+        # unpickle to the interned object
+        return (parse, (self.name,))
+
+IR_TYPES = {
+    "int": ir.IntType(32),
+    "cint": ir.IntType(32),
+    "float": ir.FloatType(),
+    "bool": ir.IntType(1),
+    "void": ir.VoidType(),
+}
+
+INT = Type("int")
+CINT = Type("cint")
+FLOAT = Type("float")
+BOOL = Type("bool")
+VOID = Type("void")
+
+_values = {typ.kind: typ for typ in (INT, CINT, FLOAT, BOOL, VOID)}
+_refs = {}
+
+def value(kind):
+    return _values[kind]
+
+def ref(elem, noalias=False):
+    key = (elem, noalias)
+    typ = _refs.get(key)
+    if typ is None:
+        typ = _refs.setdefault(key, Type("ref", elem, noalias))
+    return typ
+
+def parse(name):
+    """
+    The type spelled name, e.g. parse('noalias ref int').
+    """
+    words = name.split()
+    if words[0] == "noalias":
+        return ref(parse(" ".join(words[2:])), noalias=True)
+    if words[0] == "ref":
+        return ref(parse(" ".join(words[1:])))
+    return value(name)
@@ -0,0 +1,188 @@
+import sys
+import llvmlite.binding as llvm
+import astnodes, ektypes, codeGen, runtime, binding, cache, timing
+
+# Incremental builds for the JIT: every function is generated into a
+# module of its own, optimized with the per-function passes and kept in
+# the cache as bitcode under a fingerprint of its AST and the signatures
+# of the functions it calls.  A build regenerates only the functions
+# whose fingerprint is not cached, links them with the cached ones and a
+# freshly generated base module (the output runtime and the externs,
+# arg/argf included), and runs the whole-module passes, the inliner
+# among them, over the result.
+
+# The modules whose source shapes the cached code; an entry is only
+# reused by the same version of them
+CODE_MODULES = (astnodes, ektypes, codeGen, runtime, binding)
+
+_code_version = None
+
+def code_version():
+    global _code_version
+    if _code_version is None:
+        sources = []
+        for module in CODE_MODULES + (sys.modules[__name__],):
+            with open(module.__file__) as f:
+                sources.append(f.read())
+        _code_version = cache.digest(*sources)
+    return _code_version
+
+class FunctionCache(binding.ObjectCache):
+    """
+    The bitcode of single functions, named after their fingerprint.
+    """
+    suffix = ".bc"
+
+def create_function_cache():
+    """
+    The function cache, or None when the cache cannot be created.
+    """
+    directory = cache.cache_dir("functions")
+    if directory is None:
+        return None
+    return FunctionCache(directory)
+
+def signature(node):
+    """
+    The return type and argument types of an extern or a function.
+    """
+    if isinstance(node, astnodes.Extern):
+        return (node.ret_type, node.tdecls or [])
+    return (node.ret_type, [vdecl.type for vdecl in node.vdecls or []])
+
+def function_contents(func):
+    """
+    The contents of func as a flat list of strings and the names of the
+    functions it calls.  Lists are prefixed with their length and every
+    node class has a fixed number of slots, so different trees never
+    give the same list.  Iterative like visitor.walk, so deep
+    expressions do not exhaust the Python stack.
+    """
+    parts = []
+    calls = set()
+    stack = [func]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            parts.append("list %d" % len(node))
+            stack.extend(reversed(node))
+        elif isinstance(node, astnodes.Node):
+            parts.append(type(node).__name__)
+            if isinstance(node, astnodes.FuncCall):
+                calls.add(node.globid)
+            stack.extend(reversed([getattr(node, slot) for slot in node.__slots__]))
+        else:
+            parts.append(repr(node))
+    return parts, calls
+
+def fingerprint(parts, callees, opt_level, target_key):
+    callee_parts = ["%s %s(%s)" % (name, ret_type, ", ".join(map(str, arg_types)))
+                    for name, ret_type, arg_types in callees]
+    return cache.digest(code_version(), opt_level, target_key, *(callee_parts + parts))
+
+def parse_module(llvm_ir, target_machine):
+    mod = llvm.parse_assembly(str(llvm_ir))
+    mod.triple = target_machine.triple
+    mod.data_layout = str(target_machine.target_data)
+    mod.verify()
+    return mod
+
+def function_bitcode(func, callees, target_machine, opt_level):
+    # the function generated and optimized on its own, as bitcode
+    with timing.phase("generate_code"):
+        module = codeGen.generate_function_module(func, callees)
+    with timing.phase("ir_parse_verify"):
+        mod = parse_module(module, target_machine)
+    with timing.phase("optimize"):
+        binding.optimize_functions(mod, target_machine, opt_level)
+    return mod.as_bitcode()
+
+class ModuleBuilder():
+    """
+    Builds the LLVM module of a program one function at a time: the
+    base module holds the output runtime and the externs, every add()
+    links in one function, reused from function_cache when it is there,
+    and finish() returns the module optimized at opt_level, like
+    binding.compile_ir(target_machine, codeGen.generate_code(...)).
+    Nothing of a function but its LLVM code is kept once it is added.
+    """
+    def __init__(self, externs, undefined_args, target_machine, target_key, opt_level=0, function_cache=None):
+        self.target_machine = target_machine
+        self.target_key = target_key
+        self.opt_level = opt_level
+        self.function_cache = function_cache
+        base = codeGen.generate_code(astnodes.Prog(externs, []), undefined_args)
+        with timing.phase("ir_parse_verify"):
+            self.mod = parse_module(base, target_machine)
+        with timing.phase("optimize"):
+            binding.optimize_functions(self.mod, target_machine, opt_level)
+        # The runtime and arg/argf are internal, which would hide them
+        # from the declarations in the functions while linking
+        self.internal = [func for func in self.mod.functions if func.linkage == llvm.Linkage.internal]
+        for func in self.internal:
+            func.linkage = llvm.Linkage.external
+
+    def add(self, func, signatures):
+        """
+        Add the function func, whose callees have their signature (see
+        signature()) in signatures, key: name.
+        """
+        parts, calls = function_contents(func)
+        callees = [(name,) + signatures[name] for name in sorted(calls)]
+        key = fingerprint(parts, callees, self.opt_level, self.target_key)
+        cached = self.function_cache
+        bitcode = cached.load(key) if cached is not None else None
+        if bitcode is None:
+            bitcode = function_bitcode(func, callees, self.target_machine, self.opt_level)
+            if cached is not None:
+                cached.store(key, bitcode)
+        with timing.phase("ir_link"):
+            self.mod.link_in(llvm.parse_bitcode(bitcode))
+
+    def finish(self):
+        mod = self.mod
+        for func in self.internal:
+            func.linkage = llvm.Linkage.internal
+        with timing.phase("ir_link"):
+            mod.verify()
+        with timing.phase("optimize"):
+            binding.optimize_module(mod, self.target_machine, self.opt_level)
+        return mod
+
+def build_module(ast, undefined_args, target_machine, target_key, opt_level=0, function_cache=None):
+    """
+    The program ast as one LLVM module optimized at opt_level, reusing
+    the functions found in function_cache.
+    """
+    builder = ModuleBuilder(ast.externs, undefined_args, target_machine, target_key, opt_level, function_cache)
+    signatures = {node.globid: signature(node) for node in ast.externs + ast.funcs}
+    for func in ast.funcs:
+        builder.add(func, signatures)
+    return builder.finish()
+
+_function_cache = None
+
+def get_function_cache():
+    global _function_cache
+    if _function_cache is None:
+        _function_cache = create_function_cache()
+    return _function_cache
+
+def execute(engine, mod, opt_level=0, args=None):
+    """
+    Run the optimized module mod in engine, returning its IR text like
+    binding.compile_and_execute.
+    """
+    handle = engine.add(mod, opt_level)
+    try:
+        engine.run(handle, args=args)
+    finally:
+        engine.release(handle)
+    return handle.ir
+
+# The incremental counterpart of binding.compile_and_execute
+def compile_and_execute(ast, undefined_args, opt_level=0, args=None):
+    engine = binding.get_engine()
+    mod = build_module(ast, undefined_args, engine.target_machine, engine.target_key,
+                       opt_level, get_function_cache())
+    return execute(engine, mod, opt_level, args)
@@ -1,4 +1,7 @@
 import ply.lex as lex
+import ply
+import os, sys, shutil, importlib.util
+import cache
 
 reserved = {
     'int' : 'INT',
@@ -67,7 +70,12 @@ t_SEMICOLON = r'\;'
 
 t_ignore  = ' \t'
 
-t_VARID = r'\$[a-zA-Z_][a-zA-Z_0-9]*'
+# Identifiers are interned: the checker and the code generator use
+# them as dict keys over and over
+def t_VARID(t):
+    r'\$[a-zA-Z_][a-zA-Z_0-9]*'
+    t.value = sys.intern(t.value)
+    return t
 
 def t_SLIT(t):
     r'"[^"\n\r]*"'
@@ -76,8 +84,8 @@ def t_SLIT(t):
 
 def t_newline(t):
     r'[\n\r]+'
-    t.lexer.lineno += 1
-    pass
+    # one line per \n, or per \r in files with bare \r line ends
+    t.lexer.lineno += t.value.count("\n") or len(t.value)
 
 def t_error(t):
     print("Illegal characters: " + t.value[0])
@@ -86,6 +94,7 @@ def t_error(t):
 def t_IDENT(t):
     r'[a-zA-Z_]+[a-zA-Z_0-9]*'
     t.type = reserved.get(t.value, "IDENT")
+    t.value = sys.intern(t.value)
     return t
 
 def t_FNUMBER(t):
@@ -102,4 +111,55 @@ def t_comments(t):
     r'\#[^\r\n]*'
     pass
 
-lexer = lex.lex()
\ No newline at end of file
+def lexer_hash():
+    """
+    Key of the lexer tables: the tokens and every t_ rule with its
+    kind.  PLY tries function rules in the order of their line numbers
+    (and string rules by decreasing regex length), so the line numbers
+    are part of the key too.
+    """
+    module = sys.modules[__name__]
+    rules = []
+    for name, value in sorted(vars(module).items()):
+        if name.startswith("t_"):
+            if isinstance(value, str):
+                rules.append("%s string %s" % (name, value))
+            else:
+                rules.append("%s function %d %s" % (name, value.__code__.co_firstlineno, value.__doc__ or ""))
+    return cache.digest(ply.__version__, tokens, sorted(reserved.items()), *rules)
+
+def build_lexer():
+    """
+    Build the lexer in optimize mode, reusing the lextab module stored
+    in the ekcc cache.  A missing table is generated in a scratch
+    directory and published atomically, so concurrent compiles never
+    see a half-written table and nothing is written to the CWD.
+    """
+    module = sys.modules[__name__]
+    tab_dir = cache.cache_dir("lextab")
+    if tab_dir is None:
+        return lex.lex(module=module)
+    tab_name = "lextab_" + lexer_hash()
+    tab_path = os.path.join(tab_dir, tab_name + ".py")
+    if os.path.exists(tab_path):
+        try:
+            spec = importlib.util.spec_from_file_location(tab_name, tab_path)
+            tab = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(tab)
+            return lex.lex(module=module, optimize=True, lextab=tab)
+        except Exception:
+            pass
+    try:
+        tmp_dir = cache.private_dir(tab_dir)
+    except OSError:
+        # the cache directory is there but cannot be written
+        return lex.lex(module=module)
+    try:
+        result = lex.lex(module=module, optimize=True, lextab=tab_name, outputdir=tmp_dir)
+        cache.publish(os.path.join(tmp_dir, tab_name + ".py"), tab_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return result
+
+# Built once per process; parse() resets its position for every input
+lexer = build_lexer()
\ No newline at end of file
@@ -0,0 +1,246 @@
+from llvmlite import ir
+
+# The output runtime linked into every module: print writes into a
+# buffer that is written to the output descriptor with write(2) when it
+# fills up and when the program ends.
+#
+#   ek_print_int(i32), ek_print_float(double), ek_print_str(i8*, i64)
+#       append one line to the buffer
+#   ek_flush()
+#       write the buffer out; called by the host after run(), by the
+#       main of executables and by ek_cint_overflow
+#   ek_out_fd
+#       the descriptor written to, 1 unless the host sets it
+#   ek_cint_overflow()
+#       called when cint arithmetic overflows or divides by zero.  In
+#       ahead-of-time code it flushes the buffer, writes an error to
+#       stderr and exits with status 1; in JIT code, which runs inside
+#       the host, it flushes the buffer and jumps back to ek_run_guarded
+#   ek_run_guarded(i32*)  (JIT code only)
+#       call run() and store its result, returning 0, or return 1 when
+#       a cint overflow ended it; the host calls this instead of run()
+
+PRINT_INT = "ek_print_int"
+PRINT_FLOAT = "ek_print_float"
+PRINT_STR = "ek_print_str"
+FLUSH = "ek_flush"
+OUT_FD = "ek_out_fd"
+OVERFLOW = "ek_cint_overflow"
+OVERFLOW_MESSAGE = "error: cint overflow\n"
+RUN_GUARDED = "ek_run_guarded"
+
+# Bytes reserved for the jmp_buf of _setjmp, more than the C libraries
+# of the supported targets use (200 on x86-64 glibc, 312 on AArch64)
+JMP_BUF_SIZE = 512
+
+BUFFER_SIZE = 1 << 16
+# Room snprintf gets for one line: "%d\n" needs at most 13 bytes with
+# the NUL and "%f\n" of a float at most 48
+INT_ROOM = 16
+FLOAT_ROOM = 64
+
+i1 = ir.IntType(1)
+i8 = ir.IntType(8)
+i32 = ir.IntType(32)
+i64 = ir.IntType(64)
+voidptr = i8.as_pointer()
+void = ir.VoidType()
+
+def add_constant_string(module, name, string):
+    data = bytearray(string.encode("utf8"))
+    value = ir.Constant(ir.ArrayType(i8, len(data)), data)
+    gv = ir.GlobalVariable(module, value.type, name=name)
+    gv.linkage = "internal"
+    gv.global_constant = True
+    gv.unnamed_addr = True
+    gv.initializer = value
+    return gv.gep([ir.Constant(i32, 0), ir.Constant(i32, 0)])
+
+def add_function(module, name, ret_type, arg_types, internal=True):
+    func = ir.Function(module, ir.FunctionType(ret_type, arg_types), name=name)
+    if internal:
+        func.linkage = "internal"
+    func.attributes.add("nounwind")
+    return func
+
+def define_flush(module, buf, length, fd, write):
+    # writes buf[0:length], retrying partial writes; output that cannot
+    # be written is dropped
+    func = add_function(module, FLUSH, void, [], internal=False)
+    func.attributes.add("noinline")
+    entry = func.append_basic_block("entry")
+    loop = func.append_basic_block("loop")
+    advance = func.append_basic_block("advance")
+    done = func.append_basic_block("done")
+    builder = ir.IRBuilder(entry)
+    total = builder.load(length)
+    builder.cbranch(builder.icmp_signed(">", total, ir.Constant(i64, 0)), loop, done)
+
+    builder.position_at_end(loop)
+    offset = builder.phi(i64)
+    offset.add_incoming(ir.Constant(i64, 0), entry)
+    start = builder.gep(buf, [ir.Constant(i32, 0), offset])
+    written = builder.call(write, [builder.load(fd), start, builder.sub(total, offset)])
+    builder.cbranch(builder.icmp_signed(">", written, ir.Constant(i64, 0)), advance, done)
+
+    builder.position_at_end(advance)
+    next_offset = builder.add(offset, written)
+    offset.add_incoming(next_offset, advance)
+    builder.cbranch(builder.icmp_signed("<", next_offset, total), loop, done)
+
+    builder.position_at_end(done)
+    builder.store(ir.Constant(i64, 0), length)
+    builder.ret_void()
+    return func
+
+def reserve(builder, length, flush, room):
+    # flush first unless room more bytes fit; returns the buffer length
+    current = builder.load(length)
+    full = builder.icmp_signed(">", builder.add(current, room), ir.Constant(i64, BUFFER_SIZE))
+    with builder.if_then(full, likely=False):
+        builder.call(flush, [])
+    return builder.load(length)
+
+def define_print_number(module, name, value_type, fmt, room, buf, length, flush, snprintf):
+    func = add_function(module, name, void, [value_type])
+    builder = ir.IRBuilder(func.append_basic_block("entry"))
+    current = reserve(builder, length, flush, ir.Constant(i64, room))
+    end = builder.gep(buf, [ir.Constant(i32, 0), current])
+    count = builder.call(snprintf, [end, ir.Constant(i64, room), fmt, func.args[0]])
+    builder.store(builder.add(current, builder.sext(count, i64)), length)
+    builder.ret_void()
+    return func
+
+def define_print_str(module, buf, length, fd, flush, write, memcpy, newline):
+    func = add_function(module, PRINT_STR, void, [voidptr, i64])
+    string, size = func.args
+    builder = ir.IRBuilder(func.append_basic_block("entry"))
+    line = builder.add(size, ir.Constant(i64, 1))
+    current = reserve(builder, length, flush, line)
+    fits = builder.icmp_signed("<=", line, ir.Constant(i64, BUFFER_SIZE))
+    with builder.if_else(fits, likely=True) as (then, otherwise):
+        with then:
+            end = builder.gep(buf, [ir.Constant(i32, 0), current])
+            builder.call(memcpy, [end, string, size, ir.Constant(i1, 0)])
+            builder.store(ir.Constant(i8, ord("\n")), builder.gep(end, [size]))
+            builder.store(builder.add(current, line), length)
+        with otherwise:
+            # longer than the buffer, which reserve() has emptied
+            out = builder.load(fd)
+            builder.call(write, [out, string, size])
+            builder.call(write, [out, newline, ir.Constant(i64, 1)])
+    builder.ret_void()
+    return func
+
+def declare_runtime(module):
+    """
+    Declare the runtime functions in module, for code that is linked
+    with a module holding the runtime (see incremental.py).
+    """
+    ir.Function(module, ir.FunctionType(i64, [i32, voidptr, i64]), name="write")
+    ir.Function(module, ir.FunctionType(void, []), name=FLUSH)
+    ir.Function(module, ir.FunctionType(void, [i32]), name=PRINT_INT)
+    ir.Function(module, ir.FunctionType(void, [ir.DoubleType()]), name=PRINT_FLOAT)
+    ir.Function(module, ir.FunctionType(void, [voidptr, i64]), name=PRINT_STR)
+    ir.Function(module, ir.FunctionType(void, []), name=OVERFLOW)
+
+def define_overflow_exit(module, flush, write):
+    # ahead-of-time code: the program ends with status 1
+    exit = ir.Function(module, ir.FunctionType(void, [i32]), name="exit")
+    exit.attributes.add("noreturn")
+    message = add_constant_string(module, "cint_overflow_message", OVERFLOW_MESSAGE)
+    func = add_function(module, OVERFLOW, void, [])
+    for attribute in ("cold", "noreturn", "noinline"):
+        func.attributes.add(attribute)
+    builder = ir.IRBuilder(func.append_basic_block("entry"))
+    builder.call(flush, [])
+    builder.call(write, [ir.Constant(i32, 2), message, ir.Constant(i64, len(OVERFLOW_MESSAGE))])
+    builder.call(exit, [ir.Constant(i32, 1)])
+    builder.unreachable()
+    return func
+
+def jmp_buf(module):
+    try:
+        return module.get_global("ek_jmp_buf")
+    except KeyError:
+        pass
+    buf_type = ir.ArrayType(i8, JMP_BUF_SIZE)
+    buf = ir.GlobalVariable(module, buf_type, name="ek_jmp_buf")
+    buf.linkage = "internal"
+    buf.align = 16
+    buf.initializer = ir.Constant(buf_type, None)
+    return buf
+
+def define_overflow_return(module, flush):
+    # JIT code: exit() would end the host, so the handler unwinds to the
+    # _setjmp of ek_run_guarded, whose caller reports the error
+    longjmp = ir.Function(module, ir.FunctionType(void, [voidptr, i32]), name="_longjmp")
+    longjmp.attributes.add("noreturn")
+    func = add_function(module, OVERFLOW, void, [])
+    for attribute in ("cold", "noreturn", "noinline"):
+        func.attributes.add(attribute)
+    builder = ir.IRBuilder(func.append_basic_block("entry"))
+    builder.call(flush, [])
+    builder.call(longjmp, [builder.bitcast(jmp_buf(module), voidptr), ir.Constant(i32, 1)])
+    builder.unreachable()
+    return func
+
+def define_run_guarded(module):
+    """
+    Add ek_run_guarded to the JIT module module, after run() is defined
+    or, in the base module of incremental.py, declared.
+    """
+    try:
+        run = module.get_global("run")
+    except KeyError:
+        run = ir.Function(module, ir.FunctionType(i32, []), name="run")
+    setjmp = ir.Function(module, ir.FunctionType(i32, [voidptr]), name="_setjmp")
+    setjmp.attributes.add("returns_twice")
+    func = ir.Function(module, ir.FunctionType(i32, [i32.as_pointer()]), name=RUN_GUARDED)
+    func.attributes.add("noinline")
+    entry = func.append_basic_block("entry")
+    call = func.append_basic_block("call")
+    overflow = func.append_basic_block("overflow")
+    builder = ir.IRBuilder(entry)
+    jumped = builder.call(setjmp, [builder.bitcast(jmp_buf(module), voidptr)])
+    builder.cbranch(builder.icmp_signed("==", jumped, ir.Constant(i32, 0)), call, overflow)
+
+    builder.position_at_end(call)
+    # run() stays a function of its own: code in a function that calls
+    # _setjmp is optimized less
+    builder.store(builder.call(run, [], attrs=("noinline",)), func.args[0])
+    builder.ret(ir.Constant(i32, 0))
+
+    builder.position_at_end(overflow)
+    builder.ret(ir.Constant(i32, 1))
+    return func
+
+def define_runtime(module, aot=False):
+    """
+    Add the output runtime to module; with aot, for an object file or
+    executable instead of the JIT.
+    """
+    write = ir.Function(module, ir.FunctionType(i64, [i32, voidptr, i64]), name="write")
+    snprintf = ir.Function(module, ir.FunctionType(i32, [voidptr, i64, voidptr], var_arg=True), name="snprintf")
+    memcpy = module.declare_intrinsic("llvm.memcpy", [voidptr, voidptr, i64])
+
+    buf_type = ir.ArrayType(i8, BUFFER_SIZE)
+    buf = ir.GlobalVariable(module, buf_type, name="ek_out_buf")
+    buf.linkage = "internal"
+    buf.initializer = ir.Constant(buf_type, None)
+    length = ir.GlobalVariable(module, i64, name="ek_out_len")
+    length.linkage = "internal"
+    length.initializer = ir.Constant(i64, 0)
+    fd = ir.GlobalVariable(module, i32, name=OUT_FD)
+    fd.initializer = ir.Constant(i32, 1)
+
+    flush = define_flush(module, buf, length, fd, write)
+    define_print_number(module, PRINT_INT, i32, add_constant_string(module, "fmt_int", "%d\n\0"),
+                        INT_ROOM, buf, length, flush, snprintf)
+    define_print_number(module, PRINT_FLOAT, ir.DoubleType(), add_constant_string(module, "fmt_float", "%f\n\0"),
+                        FLOAT_ROOM, buf, length, flush, snprintf)
+    define_print_str(module, buf, length, fd, flush, write, memcpy, add_constant_string(module, "newline", "\n"))
+    if aot:
+        define_overflow_exit(module, flush, write)
+    else:
+        define_overflow_return(module, flush)
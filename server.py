@@ -0,0 +1,107 @@
+import json, os, socket, sys, traceback
+
+# Requests and replies are single JSON lines:
+#   {"op": "compile", "argv": [...], "cwd": "..."}  ->  {"exitcode": n}
+#   {"op": "shutdown"}                              ->  {"exitcode": 0}
+# A compile request carries the client's stdin, stdout and stderr as
+# SCM_RIGHTS descriptors, so the program output and diagnostics of the
+# server go straight to the client's terminal or pipes.
+
+DEFAULT_SOCKET = os.environ.get("EKCC_SOCKET") or "/tmp/ekcc-%d.sock" % os.getuid()
+
+MAX_MESSAGE = 1 << 20
+
+def read_message(conn, fds=None):
+    """
+    Read one JSON line from conn; received descriptors are appended to
+    fds if it is given.
+    """
+    data = b""
+    while not data.endswith(b"\n"):
+        if fds is not None:
+            chunk, received, _, _ = socket.recv_fds(conn, MAX_MESSAGE, 3)
+            fds.extend(received)
+        else:
+            chunk = conn.recv(MAX_MESSAGE)
+        if not chunk:
+            raise ConnectionError("connection closed in the middle of a message")
+        data += chunk
+    return json.loads(data.decode("utf8"))
+
+def send_message(conn, message, fds=()):
+    data = (json.dumps(message) + "\n").encode("utf8")
+    if fds:
+        socket.send_fds(conn, [data], list(fds))
+    else:
+        conn.sendall(data)
+
+def handle_compile(request, fds):
+    import ekcc, binding
+    cwd = os.getcwd()
+    try:
+        with binding.redirected_stdio(dict(enumerate(fds))):
+            try:
+                os.chdir(request.get("cwd", cwd))
+                return ekcc.main(request["argv"])
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print(e.code, file=sys.stderr)
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+    finally:
+        os.chdir(cwd)
+
+def serve(path):
+    """
+    Serve compile requests on the unix socket path until a shutdown
+    request arrives.  The parser and the JIT engine are built before
+    the first request; requests are handled one at a time because the
+    JIT and the redirected stdio are process-wide.
+    """
+    import yacc, binding
+    yacc.get_parser()
+    binding.get_engine()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(16)
+    print("ekcc: serving on " + path, file=sys.stderr)
+    try:
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                fds = []
+                try:
+                    request = read_message(conn, fds)
+                    if request.get("op") == "shutdown":
+                        send_message(conn, {"exitcode": 0})
+                        return 0
+                    if len(fds) != 3:
+                        raise ValueError("a compile request must carry stdin, stdout and stderr")
+                    send_message(conn, {"exitcode": handle_compile(request, fds)})
+                except (ConnectionError, ValueError, KeyError) as e:
+                    print("ekcc: bad request: " + str(e), file=sys.stderr)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        sock.close()
+        os.unlink(path)
+
+# The function called by the thin client
+def request(path, argv):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        sock.connect(path)
+        if argv == ["--shutdown"]:
+            send_message(sock, {"op": "shutdown"})
+        else:
+            send_message(sock, {"op": "compile", "argv": argv, "cwd": os.getcwd()}, fds=(0, 1, 2))
+        return read_message(sock)["exitcode"]
@@ -0,0 +1,116 @@
+import re
+import astnodes, yacc, incremental, binding, timing
+
+# The streaming front end, for sources too large to hold as one string
+# and one AST: the file is read in blocks and cut into its top-level
+# items (the externs and the function definitions), and every item is
+# lexed, parsed, checked and linked into the program's LLVM module (see
+# incremental.ModuleBuilder) before the next one is read.  Only the
+# checker's table of function signatures grows with the file, so the
+# memory of the Python front end is bounded by the largest item.
+
+BLOCK_SIZE = 1 << 20
+
+# The characters that end an item, or open or close a string literal or
+# a comment.  Strings and comments end at the end of the line, like
+# SLIT and comments in lexer.py.
+SPECIAL = re.compile(r'[{};"#\n\r]')
+
+def split_items(input, block_size=BLOCK_SIZE):
+    """
+    Yield the top-level items of the source read from the text file
+    input as (text, lineno) pairs.  An extern ends with the ';' and a
+    function with the '}' outside of any braces; any text left at the
+    end of the file is yielded as a last item.
+    """
+    pieces = []
+    depth = 0
+    state = None  # None, '"' in a string literal or '#' in a comment
+    line = 1
+    item_line = 1
+    while True:
+        block = input.read(block_size)
+        if not block:
+            break
+        start = 0
+        for match in SPECIAL.finditer(block):
+            char = match.group()
+            if char == "\n" or char == "\r":
+                if char == "\n":
+                    line += 1
+                state = None
+            elif state is not None:
+                if char == state:
+                    state = None
+            elif char == '"' or char == "#":
+                state = char
+            elif char == "{":
+                depth += 1
+            elif char == "}" or (char == ";" and depth == 0):
+                if char == "}":
+                    depth -= 1
+                if depth <= 0:
+                    depth = 0
+                    pieces.append(block[start:match.end()])
+                    start = match.end()
+                    yield "".join(pieces), item_line
+                    pieces = []
+                    item_line = line
+        pieces.append(block[start:])
+    text = "".join(pieces)
+    if text.strip():
+        yield text, item_line
+
+def parse_items(input, checker):
+    """
+    Yield the checked AST of every item of input, an Extern or a Func.
+    Raise yacc.CompilerException on the first error.
+    """
+    seen_func = False
+    for text, lineno in split_items(input):
+        tokens = yacc.lex(text, lineno)
+        if not tokens:
+            # only whitespace and comments
+            continue
+        start = "extern" if tokens[0].type == "EXTERN" else "func"
+        if start == "extern" and seen_func:
+            raise yacc.CompilerException("error: extern declarations must come before the functions")
+        seen_func = start == "func"
+        node = yacc.parse_tokens(tokens, start)
+        # the source of the item is not needed any more
+        del text, tokens
+        with timing.phase("check_violation"):
+            checker.check_violation(node)
+        yield node
+
+def build_module(input, undefined_args, target_machine, target_key, opt_level=0, function_cache=None):
+    """
+    The program read from input as one LLVM module optimized at
+    opt_level, like incremental.build_module but without holding the
+    source or the AST of more than one item.
+    """
+    checker = yacc.Checker()
+    externs = []
+    signatures = {}
+    builder = None
+    for node in parse_items(input, checker):
+        signatures[node.globid] = incremental.signature(node)
+        if isinstance(node, astnodes.Extern):
+            externs.append(node)
+            continue
+        if builder is None:
+            # the externs all come first, so the base module is complete
+            builder = incremental.ModuleBuilder(externs, undefined_args, target_machine, target_key,
+                                                opt_level, function_cache)
+        builder.add(node, signatures)
+    with timing.phase("check_run"):
+        checker.check_run()
+    return builder.finish()
+
+# The streaming counterpart of binding.compile_and_execute; with
+# function_cache the functions are cached as with -incremental
+def compile_and_execute(input, undefined_args, opt_level=0, args=None, function_cache=None):
+    engine = binding.get_engine()
+    mod = build_module(input, undefined_args, engine.target_machine, engine.target_key,
+                       opt_level, function_cache)
+    return incremental.execute(engine, mod, opt_level, args)
@@ -0,0 +1,60 @@
+"""
+Round-trip a deeply nested program through every -emit-ast format.
+
+    python3 test_files/deep_ast.py [depth]
+
+The program comes from bench/gen.py with an expression nested depth
+times (default 3000).  Every format is written and read back on a
+thread with a 256 KiB stack, where the recursive libyaml serializer
+and composer crash the process, and the tree read back must equal the
+one written; the trees are compared by their MessagePack encoding, as
+== on the dicts recurses too.  Exits with status 1 on a mismatch.
+"""
+import os, sys, tempfile, threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+import astformat, yacc, gen
+
+STACK_SIZE = 256 << 10
+
+def encoding(ast):
+    out = bytearray()
+    astformat.pack(ast.to_dict(), out)
+    return out
+
+def round_trip(depth, failures):
+    try:
+        check_formats(depth, failures)
+    except Exception as e:
+        failures.append("%s: %s" % (type(e).__name__, e))
+
+def check_formats(depth, failures):
+    ast, err_message = yacc.parse(gen.generate(depth=depth))
+    if err_message is not None:
+        failures.append(err_message)
+        return
+    expected = encoding(ast)
+    for fmt in astformat.FORMATS:
+        with tempfile.NamedTemporaryFile("wb" if fmt == "bin" else "w", suffix=".ast." + fmt) as output:
+            astformat.dump(ast, fmt, output)
+            output.flush()
+            if encoding(astformat.load(output.name)) != expected:
+                failures.append("%s: the AST read back differs" % fmt)
+            else:
+                print("%s: ok" % fmt)
+
+def main(argv):
+    depth = int(argv[0]) if argv else 3000
+    failures = []
+    threading.stack_size(STACK_SIZE)
+    thread = threading.Thread(target=round_trip, args=(depth, failures))
+    thread.start()
+    thread.join()
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+import contextlib, json, threading, time, tracemalloc
+
+# Per-phase compile statistics, in the spirit of clang's -ftime-report.
+# The compiler wraps its phases in `with timing.phase("name"):`; while a
+# Recorder is active on the thread (see record()) every phase appends
+# its wall time, CPU time and, with memory, the peak of the Python heap
+# above the heap size at its start (tracemalloc does not see memory that
+# LLVM allocates, and tracing every allocation slows the Python phases
+# several times over, so the times of a run with memory are inflated).
+# Phases do not nest; a phase run several times, as in the streaming
+# front end, adds up into one row.  Without an active Recorder a phase
+# costs one thread-local lookup.
+
+_local = threading.local()
+
+class Recorder():
+    def __init__(self, memory=False):
+        self.memory = memory
+        # list of (name, wall seconds, cpu seconds, peak bytes or None)
+        # in the order the phases first ran
+        self.phases = []
+        # key: phase name, value: its index in phases
+        self.index = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.thread_time() - start_cpu
+            peak = None
+            if self.memory:
+                peak = max(tracemalloc.get_traced_memory()[1] - start_memory, 0)
+            self.add(name, wall, cpu, peak)
+
+    def add(self, name, wall, cpu, peak):
+        if name not in self.index:
+            self.index[name] = len(self.phases)
+            self.phases.append((name, wall, cpu, peak))
+            return
+        i = self.index[name]
+        _, old_wall, old_cpu, old_peak = self.phases[i]
+        if peak is not None:
+            peak = max(peak, old_peak)
+        self.phases[i] = (name, old_wall + wall, old_cpu + cpu, peak)
+
+    def to_dict(self):
+        return {"phases": [{"name": name, "wall": wall, "cpu": cpu, "peak_bytes": peak}
+                           for name, wall, cpu, peak in self.phases],
+                "wall": sum(phase[1] for phase in self.phases),
+                "cpu": sum(phase[2] for phase in self.phases)}
+
+    def report(self):
+        """
+        The phases as a text table.
+        """
+        lines = ["%-18s %10s %10s %10s" % ("phase", "wall ms", "cpu ms", "peak KiB")]
+        for name, wall, cpu, peak in self.phases:
+            memory = "-" if peak is None else "%.1f" % (peak / 1024.0)
+            lines.append("%-18s %10.2f %10.2f %10s" % (name, wall * 1000, cpu * 1000, memory))
+        totals = self.to_dict()
+        lines.append("%-18s %10.2f %10.2f" % ("total", totals["wall"] * 1000, totals["cpu"] * 1000))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        with open(path, "w") as output:
+            json.dump(self.to_dict(), output, indent=2)
+            output.write("\n")
+
+@contextlib.contextmanager
+def record(memory=False):
+    """
+    Record the phases run by this thread inside the block into the
+    Recorder it yields.
+    """
+    recorder = Recorder(memory)
+    outer = getattr(_local, "recorder", None)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = outer
+        if started:
+            tracemalloc.stop()
+
+def active():
+    """
+    Whether a Recorder is active on this thread, for code that works
+    differently so that its phases can be told apart.
+    """
+    return getattr(_local, "recorder", None) is not None
+
+@contextlib.contextmanager
+def phase(name):
+    recorder = getattr(_local, "recorder", None)
+    if recorder is None:
+        yield
+    else:
+        with recorder.phase(name):
+            yield
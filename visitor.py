@@ -0,0 +1,47 @@
+import types
+
+def walk(root, visit):
+    """
+    Evaluate visit over the tree below root without recursion, so the
+    depth of the tree is not limited by the Python stack.
+
+    visit(node) returns either the result for node, or a generator that
+    yields the children it wants evaluated, receives the result of each
+    yielded child back, and finally returns the result for node.  The
+    generators waiting on their children are kept on an explicit stack.
+    """
+    result = visit(root)
+    if not isinstance(result, types.GeneratorType):
+        return result
+    stack = [result]
+    value = None
+    while stack:
+        try:
+            child = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            value = stop.value
+            continue
+        result = visit(child)
+        if isinstance(result, types.GeneratorType):
+            stack.append(result)
+            value = None
+        else:
+            value = result
+    return value
+
+class Visitor():
+    """
+    Base class of the tree walks: visit() dispatches every node to the
+    method that handlers names for the class of the node.
+    """
+    handlers = {}
+
+    def __init__(self):
+        self.dispatch = {kind: getattr(self, method) for kind, method in self.handlers.items()}
+
+    def visit(self, node):
+        return self.dispatch[type(node)](node)
+
+    def walk(self, node):
+        return walk(node, self.visit)
@@ -1,6 +1,7 @@
 import ply.yacc as yacc
-import lexer
-import json, sys
+import ply
+import lexer, cache, visitor, astnodes, ektypes, timing
+import json, sys, os, copy, threading
 
 tokens = lexer.tokens 
 
@@ -14,7 +15,7 @@ class Func():
         self.return_type = return_type
         self.args = args
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__, 
+        return json.dumps(self, default=lambda o: str(o) if isinstance(o, ektypes.Type) else o.__dict__, 
             sort_keys=True, 
             indent=4)
 
@@ -22,13 +23,8 @@ class CompilerException(Exception):
     def __init__(self, m):
         self.message = m
 
-funcs_declare = {} 
-variables = {}
-current_func_prefix = None
-
 logicOps = ["eq", "gt", "lt", "and", "or"]
 arithOps = ["add", "sub",  "mul", "div"]
-uOps = ["not", "minus"]
 
 precedence = (
     ('right', 'ASSIGN'),
@@ -45,82 +41,75 @@ def p_prog(p):
     '''
     prog : externs funcs
     '''
-    p[0] = {"name" : "prog"}
-    p[0]["externs"] = p[1]
-    p[0]["funcs"] = p[2]
+    p[0] = astnodes.Prog(p[1], p[2])
+
+# The lists (externs, funcs, stmts, exps, vdecls, tdecls) use left
+# recursive rules: the parser stack stays flat and every item is
+# appended to the list built so far in constant time.
 
 def p_externs(p):
     '''
     externs : 
-            | extern
-            | extern externs
+            | externs extern
     '''
-    p[0] = {"name" : "externs"}
-    if len(p) >= 2:
-        p[0]["externs"] = [p[1]]
-    if len(p) == 3:
-        if "externs" in p[2]:
-            p[0]["externs"].extend(p[2]["externs"])
+    if len(p) == 1:
+        p[0] = []
+    else:
+        p[0] = p[1]
+        p[0].append(p[2])
 
 def p_funcs(p):
     '''
     funcs : func
-          | func funcs
+          | funcs func
     '''
-    p[0] = {"name" : "funcs"}
-    p[0]["funcs"] =[p[1]]
-    if len(p) == 3:
-        if "funcs" in p[2]:
-            p[0]["funcs"].extend(p[2]["funcs"])
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[2])
 
 def p_extern(p):
     '''
     extern : EXTERN type globid LPARENTHESE RPARENTHESE SEMICOLON
            | EXTERN type globid LPARENTHESE tdecls RPARENTHESE SEMICOLON
     '''
-    p[0] = {"name" : "extern"}
-    p[0]["ret_type"] = p[2]
-    p[0]["globid"]  = p[3]
     if len(p) == 8:
-        p[0]["tdecls"] = p[5]
+        p[0] = astnodes.Extern(p[2], p[3], p[5])
+    else:
+        p[0] = astnodes.Extern(p[2], p[3])
 
 def p_func(p):
     '''
     func : DEF type globid LPARENTHESE RPARENTHESE blk
          | DEF type globid LPARENTHESE vdecls RPARENTHESE blk
     '''
-    p[0] = {"name" : "func"}
-    p[0]["ret_type"] = p[2]
-    p[0]["globid"]  = p[3]
     if len(p) == 7:
-        p[0]["blk"] = p[6]
-    if len(p) == 8:
-        p[0]["vdecls"] = p[5]
-        p[0]["blk"] = p[7]
-
-
-    
+        p[0] = astnodes.Func(p[2], p[3], None, p[6])
+    else:
+        p[0] = astnodes.Func(p[2], p[3], p[5], p[7])
 
 def p_blk(p):
     '''
     blk : LBRACE RBRACE
         | LBRACE stmts RBRACE
     '''
-    p[0] = {"name" : "blk"}
     if len(p) == 4:
-        p[0]["contents"] = p[2]
+        p[0] = astnodes.Blk(p[2])
+    else:
+        p[0] = astnodes.Blk()
 
 
 def p_stmts(p):
     '''
     stmts : stmt
-          | stmt stmts
+          | stmts stmt
     '''
-    p[0] = {"name" : "stmts"}
-    p[0]["stmts"] = [p[1]]
-    if len(p) == 3:
-        if "stmts" in p[2]:
-            p[0]["stmts"].extend(p[2]["stmts"])
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[2])
 
 def p_stmt0(p):
     '''
@@ -134,51 +123,37 @@ def p_stmt0(p):
          | IF LPARENTHESE exp RPARENTHESE stmt ELSE stmt
          | PRINT exp SEMICOLON
     '''
-    p[0] = {}
     if len(p) == 2:
         p[0] = p[1]
     elif p[1] == "return":
-        p[0]["name"] = "ret"
-        if len(p) == 4:
-            p[0]["exp"] = p[2]
+        p[0] = astnodes.Ret(p[2] if len(p) == 4 else None)
     elif len(p) == 5:
-        p[0]["name"] = "vardeclstmt"
-        p[0]["vdecl"] = p[1]
-        p[0]["exp"] = p[3]
+        p[0] = astnodes.VarDeclStmt(p[1], p[3])
     elif len(p) == 3:
-        p[0]["name"] = "expstmt"
-        p[0]["exp"] = p[1]
+        p[0] = astnodes.ExpStmt(p[1])
     elif p[1] == "while":
-        p[0]["name"] = "while"
-        p[0]["cond"] = p[3]
-        p[0]["stmt"] = p[5]
+        p[0] = astnodes.While(p[3], p[5])
     elif p[1] == "if":
-        p[0]["name"] = "if"
-        p[0]["cond"] = p[3]
-        p[0]["stmt"] = p[5]
-        if len(p) == 8:
-            p[0]["else_stmt"] = p[7]
+        p[0] = astnodes.If(p[3], p[5], p[7] if len(p) == 8 else None)
     elif p[1] == "print":
-        p[0]["name"] = "print"
-        p[0]["exp"] = p[2]
+        p[0] = astnodes.Print(p[2])
 
 def p_stmt1(p):
     '''
     stmt : PRINT SLIT SEMICOLON
     '''
-    p[0] = {"name" : "printslit", "string" : p[2]}
+    p[0] = astnodes.PrintSlit(p[2])
 
 def p_exps(p):
     '''
     exps : exp
-         | exp COMMA exps
+         | exps COMMA exp
     ''' 
-    p[0] = {"name" : "exps"}
-    if len(p) >= 2:
-        p[0]["exps"] = [p[1]]    
-    if len(p) == 4:
-        if "exps" in p[3]:
-            p[0]["exps"].extend(p[3]["exps"])
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[3])
 
 def p_exp0(p):
     '''
@@ -191,27 +166,17 @@ def p_exp0(p):
     if len(p) == 2:
         p[0] = p[1]
     elif len(p) == 5:
-        p[0] = {
-            "name": "funccall",
-            "globid": p[1],
-            "params": p[3]
-        }
+        p[0] = astnodes.FuncCall(p[1], p[3])
     elif p[1] == "(":
         p[0] = p[2]
     else:
-        p[0] = {
-            "name": "funccall",
-            "globid": p[1],
-        }
+        p[0] = astnodes.FuncCall(p[1])
 
 def p_exp1(p):
     '''
     exp : VARID
     '''
-    p[0] = {
-        "name": "varval",
-        "var": p[1]
-    }
+    p[0] = astnodes.VarVal(p[1])
 
 def p_exp2(p):
     '''
@@ -229,17 +194,12 @@ def p_binop(p):
     if len(p) == 2:
         p[0] = p[1]
     elif len(p) == 4:
-        p[0] = {
-            "name": "assign",
-            "var": p[1],
-            "exp": p[3]
-        }
+        p[0] = astnodes.Assign(p[1], p[3])
     else:
-        p[0] = {
-            "name": "caststmt",
-            "type": p[2],
-            "exp": p[4]
-        }
+        p[0] = astnodes.CastStmt(p[2], p[4])
+
+arithOpNames = {"+": "add", "-": "sub", "*": "mul", "/": "div"}
+logicOpNames = {"==": "eq", "<": "lt", ">": "gt", "&&": "and", "||": "or"}
 
 def p_arithOps(p):
     '''
@@ -248,21 +208,7 @@ def p_arithOps(p):
               | exp PLUS exp
               | exp MINUS exp
     '''
-    op = ""
-    if p[2] == '+':
-        op = "add"
-    elif p[2] == '-':
-        op = "sub"
-    elif p[2] == '*':
-        op = "mul"
-    elif p[2] == '/':
-        op = "div"
-    p[0] = {
-        "name": "binop",
-        "op": op,
-        "lhs": p[1],
-        "rhs": p[3]
-    }
+    p[0] = astnodes.Binop(arithOpNames[p[2]], p[1], p[3])
 
 def p_logicOps(p):
     '''
@@ -272,23 +218,7 @@ def p_logicOps(p):
               | exp AND exp
               | exp OR exp
     '''
-    op = ""
-    if p[2] == "==":
-        op = "eq"
-    elif p[2] == "<":
-        op = "lt"
-    elif p[2] == ">":
-        op = "gt"
-    elif p[2] == "&&":
-        op = "and"
-    elif p[2] == "||":
-        op = "or"
-    p[0] = {
-        "name": "binop",
-        "op": op,
-        "lhs": p[1],
-        "rhs": p[3]
-    }
+    p[0] = astnodes.Binop(logicOpNames[p[2]], p[1], p[3])
 
 
 def p_uop(p):
@@ -297,17 +227,9 @@ def p_uop(p):
         | MINUS exp %prec UMINUS
     '''
     if p[1]=='!':
-        p[0] = {
-            "name": "uop",
-            "op": "not",
-            "exp": p[2]
-        }
+        p[0] = astnodes.Uop("not", p[2])
     else:
-        p[0] = {
-            "name": "uop",
-            "op": "minus",
-            "exp": p[2]
-        }
+        p[0] = astnodes.Uop("minus", p[2])
 
 def p_lit0(p):
     '''
@@ -320,41 +242,25 @@ def p_lit1(p):
     '''
     lit : FNUMBER
     '''
-    p[0] = {
-        "name": "lit",
-        "value": p[1],
-        "exptype": "float"
-    }
+    p[0] = astnodes.Lit(p[1], ektypes.FLOAT)
 
 def p_lit2(p):
     '''
     lit : NUMBER
     '''
-    p[0] = {
-        "name": "lit",
-        "value": p[1],
-        "exptype": "int"
-    }
+    p[0] = astnodes.Lit(p[1], ektypes.INT)
 
 def p_true(p):
     '''
     true : TRUE
     '''
-    p[0] = {
-        "name": "lit",
-        "value": p[1] == "true",
-        "exptype": "bool"
-    }
+    p[0] = astnodes.Lit(p[1] == "true", ektypes.BOOL)
 
 def p_false(p):
     '''
     false : FALSE
     '''
-    p[0] = {
-        "name": "lit",
-        "value": p[1] == "true",
-        "exptype": "bool"
-    }
+    p[0] = astnodes.Lit(p[1] == "true", ektypes.BOOL)
 
 def p_globid(p):
     '''
@@ -370,214 +276,412 @@ def p_type(p):
          | BOOL
          | VOID
     '''
-    p[0] = p[1]
+    p[0] = ektypes.value(p[1])
 
 def p_refType(p):
     '''
     type : REF type
     '''
-    p[0] = 'ref ' + p[2]
+    p[0] = ektypes.ref(p[2])
 
 def p_noAliasRefType(p):
     '''
     type : NOALIAS REF type
     '''
-    p[0] = 'noalias ref ' + p[3]
+    p[0] = ektypes.ref(p[3], noalias=True)
 
 def p_vdecls(p):
     '''
-    vdecls : vdecl COMMA vdecls
+    vdecls : vdecls COMMA vdecl
            | vdecl
     '''
-    p[0] = {"name" : "vdecls"}
-    if len(p) >= 2:
-        p[0]["vars"] = [p[1]]    
-    if len(p) == 4:
-        if "vars" in p[3]:
-            p[0]["vars"].extend(p[3]["vars"])
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[3])
 
 def p_tdecls(p):
     '''
     tdecls : type
-           | type COMMA tdecls
+           | tdecls COMMA type
     '''
-    p[0] = {"name" : "tdecls"}
-    if len(p) >= 2:
-        p[0]["types"] = [p[1]]    
-    if len(p) == 4:
-        if "types" in p[3]:
-            p[0]["types"].extend(p[3]["types"])
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[3])
 
 def p_vdecl(p):
     '''
     vdecl : type VARID
     '''
-    p[0] = {
-        "node": "vdecl",
-        "type": p[1],
-        "var": p[2]
-    }
+    p[0] = astnodes.VDecl(p[1], p[2])
+
+def p_error(p):
+    if p is None:
+        raise CompilerException("error: syntax error at the end of the input")
+    raise CompilerException("error: syntax error at line %d, unexpected %r" % (p.lineno, p.value))
 
 def not_same_type(left_type, right_type):
-    ltype = left_type.split()[-1]
-    rtype = right_type.split()[-1]
-    return ltype != rtype
+    # a ref has the type it refers to
+    return left_type.base is not right_type.base
 
 def can_cast(cast_type, exp_type):
-    exp_type = exp_type.split()[-1] # get the type if exp_type is ref type
-    if cast_type == exp_type:
-        return True
-    elif cast_type in ["int", "cint", "float"] and exp_type in ["int", "cint", "float"]:
+    exp_type = exp_type.base # get the type if exp_type is ref type
+    if cast_type is exp_type:
         return True
-    elif cast_type == "bool" and exp_type == "bool":
+    elif cast_type.kind in ["int", "cint", "float"] and exp_type.kind in ["int", "cint", "float"]:
         return True
     else:
         return False
 
-def check_violation(node):
-    global funcs_declare
-    global current_func_prefix
-    global variables
-    global logicOps
-    global arithOps
-    global uOps
-
-    if type(node) is list:
-        for v in node:
-            check_violation(v)
-
-    elif type(node) is dict:
-        #Check: <vdecl> may not have void type.
-        #Check: a ref type may not contain a 'ref' or 'void' type.
-        if "node" in node:
-            if node["type"] == "void":
-                raise CompilerException("error: <vdecl> type cannot be void")
-            elif "noalias" not in node["type"]:
-                if "ref" in node["type"][3:] or "void" in node["type"][3:]:
-                    raise CompilerException("error: a ref type may not contain a 'ref' or 'void' type.")
-            elif "noalias" in node["type"]:
-                if "ref" in node["type"][11:] or "void" in node["type"][11:]:
-                    raise CompilerException("error: a ref type may not contain a 'ref' or 'void' type.")
-            if current_func_prefix != None:
-                variables[current_func_prefix+" "+node["var"]] = node["type"]
-            else:
-                variables[node["var"]] = node["type"]
-        
-        if "name" in node:
-            #store exptype in node
-            if node["name"] == "varval":
-                varval_key = current_func_prefix + " " + node["var"]
-                if varval_key not in variables:
-                    raise CompilerException("error: variable " + node["var"] + " has not been declared")
-                node["exptype"] = variables[varval_key]
-
-            #Check: ref var initializer must be a variable.
-            elif node["name"] == "vardeclstmt":
-                if "exp" not in node or "vdecl" not in node:
-                    raise CompilerException("error: ref var initializer must be a variable.")
-                elif "name" not in node["exp"]:
-                    raise CompilerException("error: ref var initializer must be a variable.")
-                elif "type" not in node["vdecl"]:
-                    raise CompilerException("error: ref var initializer must be a variable.")
-                elif node["vdecl"]["type"][0:3] == "ref" and node["exp"]["name"] != "varval":
-                    raise CompilerException("error: ref var initializer must be a variable.")
+class SymbolTable():
+    """
+    The variables in scope, with one scope per function and per block.
+    Every name maps to the stack of its declarations, innermost last,
+    so lookups are a single dict access; closing a scope only touches
+    the names declared in it.
+    """
+    def __init__(self):
+        self.symbols = {}
+        self.scopes = []
+
+    def push_scope(self):
+        self.scopes.append(set())
+
+    def pop_scope(self):
+        for name in self.scopes.pop():
+            types = self.symbols[name]
+            types.pop()
+            if not types:
+                del self.symbols[name]
+
+    def declare(self, name, typ):
+        scope = self.scopes[-1]
+        if name in scope:
+            self.symbols[name][-1] = typ
+        else:
+            scope.add(name)
+            self.symbols.setdefault(name, []).append(typ)
+
+    def lookup(self, name):
+        types = self.symbols.get(name)
+        if types:
+            return types[-1]
+        return None
+
+class Checker(visitor.Visitor):
+    """
+    The semantic checks of one compilation and their state: the
+    declared functions and the variables in scope.  Every handler
+    checks one class of node and stores the type of expressions in
+    their exptype.
+    """
+    handlers = {
+        astnodes.Prog: "check_prog",
+        astnodes.Extern: "check_extern",
+        astnodes.Func: "check_func",
+        astnodes.VDecl: "check_vdecl",
+        astnodes.Blk: "check_blk",
+        astnodes.Ret: "check_exp_child",
+        astnodes.ExpStmt: "check_exp_child",
+        astnodes.Print: "check_exp_child",
+        astnodes.PrintSlit: "check_leaf",
+        astnodes.VarDeclStmt: "check_vardeclstmt",
+        astnodes.While: "check_cond_stmt",
+        astnodes.If: "check_cond_stmt",
+        astnodes.FuncCall: "check_funccall",
+        astnodes.VarVal: "check_varval",
+        astnodes.Lit: "check_leaf",
+        astnodes.Binop: "check_binop",
+        astnodes.Uop: "check_uop",
+        astnodes.Assign: "check_assign",
+        astnodes.CastStmt: "check_caststmt",
+    }
 
-            #Check: all functions must be declared before use
-            elif node["name"] == "funccall":
-                if node["globid"] not in funcs_declare:
-                    raise CompilerException("error: function " + node["globid"] + " has not been declared")
-                if "params" in node and "exps" in node["params"]:
-                    for x in range(len(node["params"]["exps"])):
-                        if "ref" in funcs_declare[node["globid"]].args[x] and node["params"]["exps"][x]["name"] != "varval":
-                            raise CompilerException("error: ref var initializer must be a variable.")
-                node["exptype"] = funcs_declare[node["globid"]].return_type
-
-            #Check: a function may not return a ref type.
-            #Check: all programs define the "run" function with the right type.
-            elif node["name"] == "func":
-                args=[]
-                if node["globid"] == "run":
-                    if "run" in funcs_declare:
-                        raise CompilerException("error: run function should only declare once")
-                    elif node['ret_type'] != "int":
-                        raise CompilerException("error: run function should only return int type")
-                    elif "vdecls" in node:
-                        raise CompilerException("error: run function should take no arguments")
-                else:
-                    if "ref" in node['ret_type']:
-                        raise CompilerException("error: function cannot return ref type")
-                    if "vdecls" in node:
-                        for arg in node["vdecls"]["vars"]:
-                            args.append(arg["type"])
-                funcs_declare[node["globid"]] = Func(node["globid"], node['ret_type'], args)
-                current_func_prefix = node["ret_type"]+" "+node["globid"]
-
-            elif node["name"] == "extern":
-                args=[]
-                if "tdecls" in node and "types" in node["tdecls"]:
-                    args = node["tdecls"]["types"]
-                funcs_declare[node["globid"]] = Func(node["globid"], node['ret_type'], args)
-
-        #visit children node
-        for k, v in node.items():
-            if v is list or dict:
-                check_violation(v)
-
-        #Check: the types on both sides of binops are the same
-        if "op" in node:
-            if node["op"] in logicOps:
-                if not_same_type(node["lhs"]["exptype"], node["rhs"]["exptype"]):
-                    raise CompilerException("error: the type on two sides do not match")
-                node["exptype"] = "bool"
-
-            elif node["op"] in arithOps:
-                if not_same_type(node["lhs"]["exptype"], node["rhs"]["exptype"]):
-                    raise CompilerException("error: the type on two sides do not match")
-                node["exptype"] = node["rhs"]["exptype"]
-
-            elif node["op"] in uOps:
-                node["exptype"] = node["exp"]["exptype"]
-
-        if "name" in node:
-            if node["name"] == "assign":
-                if current_func_prefix is not None:
-                    var_key = current_func_prefix + " " + node["var"]
-                else:
-                    var_key = node["var"]
-                if var_key not in variables:
-                    raise CompilerException("error: variable " + node["var"] + " has not been declared")
-                if not_same_type(variables[var_key], node["exp"]["exptype"]):
-                    raise CompilerException("error: the type on two sides do not match")
-            
-            elif node["name"] == "caststmt":
-                if can_cast(node["type"], node["exp"]["exptype"]):
-                    node["exptype"] = node["type"]
-                else:
-                    raise CompilerException("error: cannot cast {} to {}", node["exp"]["exptype"], node["type"])
-
-            elif node["name"] == "func":
-                for k, v in variables.copy().items():
-                    if k.startswith(current_func_prefix):
-                        variables.pop(k)
-                current_func_prefix = None
-
-def check_run():
-    global funcs_declare
-    if "run" not in funcs_declare:
-        raise CompilerException("error: run function should be declared once.")
-
-# The function called by ekcc.py
+    def __init__(self):
+        visitor.Visitor.__init__(self)
+        self.funcs_declare = {}
+        self.variables = SymbolTable()
+
+    def check_violation(self, node):
+        self.walk(node)
+
+    def check_leaf(self, node):
+        pass
+
+    def check_prog(self, node):
+        for extern in node.externs:
+            yield extern
+        for func in node.funcs:
+            yield func
+
+    #Check: a ref type may not contain a 'ref' or 'void' type.
+    def check_extern(self, node):
+        args = node.tdecls or []
+        for typ in args:
+            if typ.is_ref and typ.elem.kind in ["ref", "void"]:
+                raise CompilerException("error: a ref type may not contain a 'ref' or 'void' type.")
+        self.funcs_declare[node.globid] = Func(node.globid, node.ret_type, args)
+
+    #Check: a function may not return a ref type.
+    #Check: all programs define the "run" function with the right type.
+    def check_func(self, node):
+        args=[]
+        if node.globid == "run":
+            if "run" in self.funcs_declare:
+                raise CompilerException("error: run function should only declare once")
+            elif node.ret_type is not ektypes.INT:
+                raise CompilerException("error: run function should only return int type")
+            elif node.vdecls is not None:
+                raise CompilerException("error: run function should take no arguments")
+        else:
+            if node.ret_type.is_ref:
+                raise CompilerException("error: function cannot return ref type")
+            if node.vdecls is not None:
+                for arg in node.vdecls:
+                    args.append(arg.type)
+        self.funcs_declare[node.globid] = Func(node.globid, node.ret_type, args)
+        # the scope of the arguments
+        self.variables.push_scope()
+        if node.vdecls is not None:
+            for vdecl in node.vdecls:
+                yield vdecl
+        yield node.blk
+        self.variables.pop_scope()
+
+    #Check: <vdecl> may not have void type.
+    #Check: a ref type may not contain a 'ref' or 'void' type.
+    def check_vdecl(self, node):
+        if node.type is ektypes.VOID:
+            raise CompilerException("error: <vdecl> type cannot be void")
+        elif node.type.is_ref and node.type.elem.kind in ["ref", "void"]:
+            raise CompilerException("error: a ref type may not contain a 'ref' or 'void' type.")
+        self.variables.declare(node.var, node.type)
+
+    def check_blk(self, node):
+        self.variables.push_scope()
+        if node.stmts is not None:
+            for stmt in node.stmts:
+                yield stmt
+        self.variables.pop_scope()
+
+    def check_exp_child(self, node):
+        if node.exp is not None:
+            yield node.exp
+
+    #Check: ref var initializer must be a variable.
+    def check_vardeclstmt(self, node):
+        if node.vdecl.type.is_ref and not isinstance(node.exp, astnodes.VarVal):
+            raise CompilerException("error: ref var initializer must be a variable.")
+        yield node.vdecl
+        yield node.exp
+
+    def check_cond_stmt(self, node):
+        yield node.cond
+        yield node.stmt
+        if isinstance(node, astnodes.If) and node.else_stmt is not None:
+            yield node.else_stmt
+
+    #Check: all functions must be declared before use
+    def check_funccall(self, node):
+        if node.globid not in self.funcs_declare:
+            raise CompilerException("error: function " + node.globid + " has not been declared")
+        func = self.funcs_declare[node.globid]
+        node.exptype = func.return_type
+        if node.params is not None:
+            for arg_type, exp in zip(func.args, node.params):
+                if arg_type.is_ref and not isinstance(exp, astnodes.VarVal):
+                    raise CompilerException("error: ref var initializer must be a variable.")
+            for exp in node.params:
+                yield exp
+
+    def check_varval(self, node):
+        var_type = self.variables.lookup(node.var)
+        if var_type is None:
+            raise CompilerException("error: variable " + node.var + " has not been declared")
+        node.exptype = var_type
+
+    #Check: the types on both sides of binops are the same
+    def check_binop(self, node):
+        yield node.lhs
+        yield node.rhs
+        if node.op in logicOps:
+            if not_same_type(node.lhs.exptype, node.rhs.exptype):
+                raise CompilerException("error: the type on two sides do not match")
+            node.exptype = ektypes.BOOL
+
+        elif node.op in arithOps:
+            if not_same_type(node.lhs.exptype, node.rhs.exptype):
+                raise CompilerException("error: the type on two sides do not match")
+            node.exptype = node.rhs.exptype
+
+    def check_uop(self, node):
+        yield node.exp
+        node.exptype = node.exp.exptype
+
+    def check_assign(self, node):
+        yield node.exp
+        var_type = self.variables.lookup(node.var)
+        if var_type is None:
+            raise CompilerException("error: variable " + node.var + " has not been declared")
+        if not_same_type(var_type, node.exp.exptype):
+            raise CompilerException("error: the type on two sides do not match")
+
+    def check_caststmt(self, node):
+        yield node.exp
+        if can_cast(node.type, node.exp.exptype):
+            node.exptype = node.type
+        else:
+            raise CompilerException("error: cannot cast {} to {}".format(node.exp.exptype, node.type))
+
+    def check_run(self):
+        if "run" not in self.funcs_declare:
+            raise CompilerException("error: run function should be declared once.")
+
+def grammar_hash(start="prog"):
+    """
+    Key of the parse tables: every production docstring, the
+    precedence table, the lexer tokens and the start symbol.
+    """
+    module = sys.modules[__name__]
+    rules = []
+    for name, value in sorted(vars(module).items()):
+        if name.startswith("p_") and callable(value):
+            rules.append(name + " " + (value.__doc__ or ""))
+    return cache.digest(ply.__version__, tokens, precedence, start, *rules)
+
+def build_parser(start="prog"):
+    """
+    Build the LALR parser for start in optimize mode from tables
+    pickled in the ekcc cache.  Missing tables are generated once,
+    written to a scratch file and published atomically; nothing goes
+    to the CWD.  The parsers of single items (start 'extern' or
+    'func') leave most rules unused, so their warnings are dropped.
+    """
+    module = sys.modules[__name__]
+    options = dict(module=module, start=start, optimize=True, debug=False)
+    if start != "prog":
+        options["errorlog"] = yacc.NullLogger()
+    tab_dir = cache.cache_dir("parsetab")
+    if tab_dir is None:
+        return yacc.yacc(write_tables=False, **options)
+    tab_path = os.path.join(tab_dir, grammar_hash(start) + ".pickle")
+    if os.path.exists(tab_path):
+        try:
+            return yacc.yacc(picklefile=tab_path, **options)
+        except Exception:
+            pass
+    try:
+        tmp_dir = cache.private_dir(tab_dir)
+    except OSError:
+        # the cache directory is there but cannot be written
+        return yacc.yacc(write_tables=False, **options)
+    tmp_path = os.path.join(tmp_dir, "parsetab.pickle")
+    try:
+        result = yacc.yacc(picklefile=tmp_path, **options)
+        cache.publish(tmp_path, tab_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.rmdir(tmp_dir)
+    return result
+
+# key: start symbol, value: its parser
+_parsers = {}
+_parser_lock = threading.Lock()
+_local = threading.local()
+
+def get_parser(start="prog"):
+    """
+    The parser for start of the calling thread.  The parse tables are
+    built once per process and shared; every thread gets its own copy
+    of the parser (and of the lexer, see get_lexer) because PLY keeps
+    the parse state in them.
+    """
+    if not hasattr(_local, "parsers"):
+        _local.parsers = {}
+    if start not in _local.parsers:
+        with _parser_lock:
+            if start not in _parsers:
+                _parsers[start] = build_parser(start)
+        _local.parsers[start] = copy.copy(_parsers[start])
+    return _local.parsers[start]
+
+class TokenList():
+    """
+    A lexer for the parser that hands out tokens lexed beforehand.
+    """
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+
+    def token(self):
+        return next(self.tokens, None)
+
+def get_lexer():
+    if not hasattr(_local, "lexer"):
+        _local.lexer = lexer.lexer.clone()
+    return _local.lexer
+
+def lex(text, lineno=1):
+    """
+    The tokens of text as a list, counting lines from lineno.
+    """
+    scanner = get_lexer()
+    scanner.lineno = lineno
+    with timing.phase("lex"):
+        scanner.input(text)
+        return list(iter(scanner.token, None))
+
+def parse_tokens(tokens, start="prog"):
+    """
+    The AST that the parser for start builds out of tokens.  Raises
+    CompilerException on a syntax error.
+    """
+    parser = get_parser(start)
+    with timing.phase("parse"):
+        return parser.parse(lexer=TokenList(tokens))
+
+def parse_text(text, start="prog"):
+    """
+    The AST that the parser for start builds out of text, pulling the
+    tokens from the lexer as it goes.  Raises CompilerException on a
+    syntax error.
+    """
+    scanner = get_lexer()
+    scanner.lineno = 1
+    scanner.input(text)
+    return get_parser(start).parse(lexer=scanner)
+
+# The function called by ekcc.py; safe to call repeatedly and from
+# several threads at once
 def parse(input_content):
-    parser = yacc.yacc()
-    result = parser.parse(input_content)
-
+    # while phases are recorded the input is lexed completely before
+    # parsing so that the two phases can be timed apart
+    try:
+        if timing.active():
+            result = parse_tokens(lex(input_content))
+        else:
+            result = parse_text(input_content)
+    except CompilerException as e:
+        return (None, e.message)
+    return check(result)
+
+def check(result):
+    """
+    Run the semantic checks over the AST result, as parse() does.
+    """
+    if result is None:
+        return (None, "error: syntax error")
     #Compiler ruturns ( ast tree, error message) 
     try:
-        check_violation(result)
-        check_run()
+        checker = Checker()
+        with timing.phase("check_violation"):
+            checker.check_violation(result)
+        with timing.phase("check_run"):
+            checker.check_run()
     except CompilerException as e:
         return (None, e.message)
 
     return (result, None)
-
-    